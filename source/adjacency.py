@@ -0,0 +1,267 @@
+"""
+Chiefdom adjacency and a neighbor contrast engine for spotting chiefdoms whose
+metrics stand out from those of their neighbors.
+
+The adjacency is a symmetric scipy.sparse CSR matrix over the gazetteer chiefdom
+IDs. It is read from an edge list, ADJACENCY_PATH by default, a CSV with one
+pair of bordering chiefdoms per row:
+    chiefdom_a,chiefdom_b
+    Badjia,Bagbo
+    ...
+Names must match the chiefdoms of sierra_leone.py. The repo does not ship such a
+file, the borders have to come from a map of the chiefdoms (e.g. the OCHA
+reference maps under data/un_maps). Until one exists, load_adjacency falls back
+to treating the chiefdoms of a district as each other's neighbors and warns.
+
+neighbor_contrast compares every chiefdom with the mean and median of its
+neighbors and tests the difference against random relabelings of the chiefdoms.
+Permutations are processed in batches, each batch being a single sparse-dense
+matrix product, so thousands of permutations over every chiefdom take seconds.
+"""
+
+import argparse
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from gazetteer import GAZETTEER, UNRESOLVED
+
+ADJACENCY_PATH = '../data/chiefdom_adjacency.csv'
+EDGE_COLUMNS = ['chiefdom_a', 'chiefdom_b']
+CONTRAST_COLUMNS = ['value', 'degree', 'neighbor_mean', 'neighbor_median', 'contrast', 'z_score', 'p_value']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Compares a per-chiefdom metric of the SMAC cube with the chiefdoms around it.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--adjacency_path',
+        type=str,
+        default=ADJACENCY_PATH,
+        help='Edge list of bordering chiefdoms, see adjacency.py.',
+    )
+    parser.add_argument(
+        '--cube_path',
+        type=str,
+        default='../data/cache/cube.npz',
+        help='Cube built by cube.py.',
+    )
+    parser.add_argument(
+        '--metric',
+        type=str,
+        default='follow_up_d_all',
+        help='Metric of the cube, after summing over sex and age (e.g. follow_up_d_all).',
+    )
+    parser.add_argument(
+        '--per',
+        type=str,
+        default=None,
+        help='Optional metric the values are divided by, e.g. follow_up_visits.',
+    )
+    parser.add_argument(
+        '--n_permutations',
+        type=int,
+        default=10000,
+        help='Number of random relabelings the p-values are estimated from.',
+    )
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=15,
+        help='Number of chiefdoms with the smallest p-values to print.',
+    )
+
+    return parser
+
+
+def main(
+        adjacency_path=ADJACENCY_PATH,
+        cube_path='../data/cache/cube.npz',
+        metric='follow_up_d_all',
+        per=None,
+        n_permutations=10000,
+        top=15,
+):
+    from cube import SMACCube
+
+    cube = SMACCube.load(cube_path).rollup(demographic='total')
+    values = chiefdom_metric(cube, metric, per=per)
+    contrast = neighbor_contrast(values, load_adjacency(adjacency_path), n_permutations=n_permutations)
+
+    # Smallest p-values first, ties broken by the size of the z-score.
+    order = np.lexsort([-contrast.z_score.abs().to_numpy(), contrast.p_value.to_numpy()])
+    with pd.option_context('display.precision', 3, 'display.width', 120):
+        print(contrast.iloc[order[:top]])
+
+
+def load_adjacency(path=ADJACENCY_PATH):
+    """
+    Reads an edge list of bordering chiefdoms, see the module docstring. Edges are
+    made symmetric and duplicates or self loops are dropped.
+
+    Falls back to district_adjacency, with a warning, when the file does not exist.
+
+    Returns:
+        A symmetric CSR matrix of shape (n_chiefdoms, n_chiefdoms) with ones for
+        neighbors, rows and columns are gazetteer chiefdom IDs.
+    """
+    path = Path(path)
+    if not path.is_file():
+        warnings.warn(
+            f'{path} does not exist, treating chiefdoms of the same district as neighbors instead.',
+            stacklevel=2,
+        )
+        return district_adjacency()
+
+    edges = pd.read_csv(path, usecols=EDGE_COLUMNS, dtype=str)
+    edges = edges.apply(lambda x: x.str.strip())
+    ids = {col: GAZETTEER.encode('chiefdom', edges[col]) for col in EDGE_COLUMNS}
+    unknown = sorted(set(
+        name
+        for col in EDGE_COLUMNS
+        for name in edges[col][ids[col] == UNRESOLVED]
+    ), key=str)
+    if unknown:
+        raise ValueError(f'Unknown chiefdoms in {path}: {", ".join(map(str, unknown))}!')
+
+    return adjacency_matrix(ids['chiefdom_a'], ids['chiefdom_b'])
+
+
+def district_adjacency():
+    """
+    Returns the adjacency in which every chiefdom neighbors the other chiefdoms of
+    its district. This is only a stand-in for real borders.
+    """
+    districts = GAZETTEER.parents['chiefdom']
+    rows, cols = np.nonzero(districts[:, None] == districts[None, :])
+    return adjacency_matrix(rows, cols)
+
+
+def adjacency_matrix(ids_a, ids_b):
+    n = len(GAZETTEER.names['chiefdom'])
+    ids_a, ids_b = np.asarray(ids_a), np.asarray(ids_b)
+    keep = ids_a != ids_b
+    rows = np.concatenate([ids_a[keep], ids_b[keep]])
+    cols = np.concatenate([ids_b[keep], ids_a[keep]])
+    matrix = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    # Duplicate edges were summed, neighbors are neighbors once.
+    matrix.data[:] = 1.
+    return matrix
+
+
+def chiefdom_metric(cube, metric, per=None):
+    """
+    Sums a metric of a SMACCube over time for every chiefdom.
+
+    Args:
+        cube: A SMACCube of chiefdoms.
+        metric: Name of the metric.
+        per: Optional name of a metric to divide by, e.g. visits. Chiefdoms where it
+            is zero are NaN.
+
+    Returns:
+        A float64 array indexed by chiefdom ID. Chiefdoms without any visit are NaN
+        since a zero there means no data rather than no events.
+    """
+    if cube.level != 'chiefdom':
+        raise ValueError(f'Expected a cube of chiefdoms, got {cube.level}s!')
+
+    totals = cube.values[:, :-1, :].sum(axis=0).astype('float64')
+    values = totals[:, cube.metrics.index(metric)].copy()
+    visits = sum(totals[:, cube.metrics.index(name)] for name in ['trigger_visits', 'follow_up_visits'])
+    values[visits == 0] = np.nan
+    if per is not None:
+        denominator = totals[:, cube.metrics.index(per)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(denominator > 0, values / denominator, np.nan)
+    return values
+
+
+def neighbor_contrast(values, adjacency, n_permutations=10000, batch_size=1000, seed=0):
+    """
+    Compares the value of every chiefdom with its neighbors.
+
+    Chiefdoms with a NaN value are left out, both as chiefdoms and as neighbors.
+    For the others:
+        - neighbor_mean, neighbor_median: over the neighbors with a value.
+        - contrast: value - neighbor_mean.
+        - z_score: the contrast divided by the standard deviation of the contrasts of
+          every chiefdom.
+        - p_value: two-sided permutation p-value of the contrast. All of the values,
+          including each chiefdom's own, are randomly reassigned to the chiefdoms
+          n_permutations times, each time giving a contrast for every chiefdom, and
+          the p-value is the share of those at least as far from zero as the observed
+          one, (1 + count) / (1 + n).
+
+    Args:
+        values: Array of one value per chiefdom ID, e.g. from chiefdom_metric.
+        adjacency: Sparse matrix from load_adjacency.
+        n_permutations: Number of random reassignments.
+        batch_size: Number of reassignments evaluated by one matrix product.
+        seed: Seed of the random number generator.
+
+    Returns:
+        A DataFrame indexed by chiefdom name with CONTRAST_COLUMNS.
+    """
+    values = np.asarray(values, dtype='float64')
+    present = ~np.isnan(values)
+    adjacency = scipy.sparse.csr_matrix(adjacency)[present][:, present]
+    x = values[present]
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        neighbor_mean = adjacency @ x / degree
+    contrast = x - neighbor_mean
+    z_score = contrast / np.nanstd(contrast)
+
+    # Contrasts under random reassignments of the values, one column per permutation.
+    # The whole vector is permuted, so the contrast of a chiefdom under a permutation
+    # is between the value reassigned to it and those reassigned to its neighbors.
+    rng = np.random.default_rng(seed)
+    exceed = np.zeros(len(x), dtype=np.int64)
+    for start in range(0, n_permutations, batch_size):
+        n = min(batch_size, n_permutations - start)
+        permuted = rng.permuted(np.tile(x, (n, 1)), axis=1).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            permuted_contrast = permuted - (adjacency @ permuted) / degree[:, None]
+        exceed += (np.abs(permuted_contrast) >= np.abs(contrast)[:, None] - 1e-12).sum(axis=1)
+    p_value = np.where(degree > 0, (1 + exceed) / (1 + n_permutations), np.nan)
+
+    result = pd.DataFrame(
+        np.nan,
+        index=pd.Index(GAZETTEER.names['chiefdom'], name='chiefdom'),
+        columns=CONTRAST_COLUMNS,
+    )
+    result['value'] = values
+    result.loc[present, 'degree'] = degree
+    result.loc[present, 'neighbor_mean'] = neighbor_mean
+    result.loc[present, 'neighbor_median'] = neighbor_medians(adjacency, x)
+    result.loc[present, 'contrast'] = contrast
+    result.loc[present, 'z_score'] = z_score
+    result.loc[present, 'p_value'] = p_value
+    return result
+
+
+def neighbor_medians(adjacency, x):
+    """
+    Returns the median of x over the neighbors of every row of a CSR matrix, NaN for
+    rows without neighbors. The neighbors are padded into a dense matrix with NaN.
+    """
+    degree = np.diff(adjacency.indptr)
+    padded = np.full((len(degree), max(degree.max(initial=0), 1)), np.nan)
+    rows = np.repeat(np.arange(len(degree)), degree)
+    positions = np.arange(len(adjacency.indices)) - np.repeat(adjacency.indptr[:-1], degree)
+    padded[rows, positions] = x[adjacency.indices]
+    with warnings.catch_warnings():
+        # Rows without neighbors are all NaN, their median is NaN as intended.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(padded, axis=1)
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
@@ -0,0 +1,482 @@
+"""
+Attack rates of the SMAC visits in people and over places, with bootstrap
+confidence intervals.
+
+Visits come from the trigger sheet (Trigger_NA by default, Trigger_Ave fills in
+missing population totals) and Follow_Up. Every visit is assigned to a community,
+the Name_of_community within its chiefdom, and the communities give:
+    - population: the largest number of people counted at any visit, Grand_total
+      or Total_male + Total_female, NaN when no visit counted anyone.
+    - sick, deaths: the ss_* and d_* counts summed over all visits.
+Rows whose chiefdom is not in the gazetteer are left out.
+
+Two attack rates are computed for every location at each of LEVELS:
+    - people_rate: cases / population, over the communities with a population,
+      so every person weighs the same.
+    - unit_rate: the mean of the people_rate of the units of the location, so every
+      unit weighs the same whatever its population. The units are the communities
+      of a chiefdom or section and the chiefdoms of a district or province
+      (UNIT_LEVELS), a community is its own unit. For districts this is the attack
+      rate over chiefdoms of problem 4. Units without a population are left out.
+
+All levels are computed by a single group reduction: the units of every level are
+stacked into one sparse matrix whose columns are (location, quantity) pairs, so
+that the totals of every location are one product with a vector of ones. The
+bootstrap resamples the units of every location with replacement. A batch of
+replicates is a matrix of resampled indices, turned into a matrix of counts and
+multiplied with the same sparse matrix, which takes a few seconds for 10,000
+replicates. Intervals are percentile intervals, locations with a single unit get
+none since every replicate is the same.
+"""
+
+import argparse
+import re
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import etl
+from cube import DEMOGRAPHICS, TRIGGER_SHEET
+from gazetteer import GAZETTEER, UNRESOLVED
+
+LEVELS = ('community', 'section', 'chiefdom', 'district', 'province')
+UNIT_LEVELS = {
+    'community': 'community',
+    'section': 'community',
+    'chiefdom': 'community',
+    'district': 'chiefdom',
+    'province': 'chiefdom',
+}
+CASE_PREFIXES = {'sick': 'ss', 'deaths': 'd'}
+FOLLOW_UP_SHEET = 'Follow_Up'
+
+# Quantities summed over the units of a location, rated_units are the units with a
+# population and {kind}_rates the sum of their people rates.
+QUANTITIES = (
+    ['units', 'rated_units', 'population'] +
+    [f'{kind}_counted' for kind in CASE_PREFIXES] +
+    [f'{kind}_rates' for kind in CASE_PREFIXES]
+)
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def get_parser():
+    def parse_bool(x):
+        return x.lower() in ('t', 'true', '1', 'y', 'yes')
+
+    parser = argparse.ArgumentParser(
+        description='Computes attack rates in people and over places with bootstrap confidence intervals.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--data_kind',
+        type=str,
+        default='clean',
+        choices=['clean', 'raw'],
+        help='Data set to use.',
+    )
+    parser.add_argument(
+        '--trigger_sheet',
+        type=str,
+        default=TRIGGER_SHEET,
+        choices=['Trigger_Ave', 'Trigger_NA'],
+        help='Sheet of the trigger visits.',
+    )
+    parser.add_argument(
+        '--level',
+        type=str,
+        default='district',
+        choices=LEVELS,
+        help='Level whose attack rates are printed.',
+    )
+    parser.add_argument(
+        '--n_bootstrap',
+        type=int,
+        default=10000,
+        help='Number of bootstrap replicates.',
+    )
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='Confidence level of the intervals.',
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default=None,
+        help='Directory the attack rates of every level are written to as CSV, if given.',
+    )
+    parser.add_argument(
+        '--verbose',
+        type=parse_bool,
+        default=False,
+        help='Print the number of visits used and the time taken.',
+    )
+
+    return parser
+
+
+def main(
+        data_kind='clean',
+        trigger_sheet=TRIGGER_SHEET,
+        level='district',
+        n_bootstrap=10000,
+        confidence=0.95,
+        output_path=None,
+        verbose=False,
+):
+    dfs = etl.clean_smac_data(etl.load_smac_data(data_kind), location_ids=True)
+
+    start = time.time()
+    rates = attack_rates(
+        dfs,
+        trigger_sheet=trigger_sheet,
+        n_bootstrap=n_bootstrap,
+        confidence=confidence,
+        verbose=verbose,
+    )
+    if verbose:
+        print(f'Computed the attack rates of every level in {time.time() - start:.2f}s')
+
+    if output_path is not None:
+        output_path = Path(output_path)
+        output_path.mkdir(parents=True, exist_ok=True)
+        for name, df in rates.items():
+            df.to_csv(output_path / f'{name}_attack_rates.csv')
+
+    with pd.option_context('display.max_rows', 200, 'display.max_columns', None, 'display.width', 200, 'display.precision', 4):
+        print(rates[level])
+
+
+def attack_rates(
+        dfs,
+        trigger_sheet=TRIGGER_SHEET,
+        n_bootstrap=10000,
+        confidence=0.95,
+        batch_size=200,
+        seed=0,
+        verbose=False,
+):
+    """
+    Computes the attack rates in people and over units at every level, see the
+    module docstring.
+
+    Args:
+        dfs: The cleaned sheets, with or without location IDs.
+        trigger_sheet: Trigger_NA or Trigger_Ave.
+        n_bootstrap: Number of bootstrap replicates, 0 skips the intervals.
+        confidence: Confidence level of the percentile intervals.
+        batch_size: Number of replicates resampled at once.
+        seed: Seed of the random number generator.
+        verbose: Print the number of visits left out.
+
+    Returns:
+        A dictionary mapping each of LEVELS to a DataFrame indexed by location with
+        the number of units, the population, the cases and, for each kind of case,
+        its people and unit rates with their lower and upper bounds.
+    """
+    visits = visit_table(dfs, trigger_sheet)
+    unresolved = visits.chiefdom_id.to_numpy() == UNRESOLVED
+    if verbose:
+        print(f'Left out {unresolved.sum()} of {len(visits)} visits with unresolved chiefdoms')
+    communities = community_table(visits[~unresolved])
+    chiefdoms = chiefdom_table(communities)
+
+    groups = level_groups(communities, chiefdoms)
+    matrix, codes, offsets = group_matrix(groups)
+    totals = np.asarray(matrix.sum(axis=0)).reshape(-1, len(QUANTITIES))
+
+    bounds = None
+    if n_bootstrap > 0:
+        bounds = bootstrap_bounds(matrix, codes, totals, n_bootstrap, confidence, batch_size, seed)
+
+    rates = dict()
+    for i, (level, (_, _, labels)) in enumerate(groups.items()):
+        locations = slice(offsets[i], offsets[i + 1])
+        rates[level] = rate_frame(totals[locations], None if bounds is None else bounds[:, locations], labels)
+    return rates
+
+
+def visit_table(dfs, trigger_sheet=TRIGGER_SHEET):
+    """
+    Returns one row per visit of the trigger sheet and Follow_Up with the chiefdom
+    and section IDs, the community name, the number of people and the cases.
+    """
+    visits = []
+    for sheet in [trigger_sheet, FOLLOW_UP_SHEET]:
+        df = dfs[sheet]
+        ids = df if 'chiefdom_id' in df.columns else etl.add_location_ids(df[['District', 'Chiefdom', 'Section']].copy())
+        visit = pd.DataFrame({
+            'chiefdom_id': ids.chiefdom_id.to_numpy(dtype=np.int64),
+            'section_id': ids.section_id.to_numpy(dtype=np.int64),
+            'community': df.Name_of_community.to_numpy(dtype=object),
+            'population': visit_population(df),
+        })
+        for kind, prefix in CASE_PREFIXES.items():
+            counts = df[[f'{prefix}_{demographic}' for demographic in DEMOGRAPHICS]]
+            visit[kind] = counts.apply(pd.to_numeric, errors='coerce').sum(axis=1).to_numpy(dtype='float64')
+        visits.append(visit)
+    return pd.concat(visits, ignore_index=True)
+
+
+def visit_population(df):
+    """
+    Returns the number of people counted at each visit, Grand_total where a sheet has
+    it and Total_male + Total_female otherwise.
+    """
+    totals = df[['Total_male', 'Total_female']].apply(pd.to_numeric, errors='coerce')
+    population = totals.sum(axis=1, min_count=1).to_numpy(dtype='float64')
+    if 'Grand_total' in df.columns:
+        grand_total = pd.to_numeric(df.Grand_total, errors='coerce').to_numpy(dtype='float64')
+        population = np.where(np.isnan(grand_total), population, grand_total)
+    return population
+
+
+def community_table(visits):
+    """
+    Combines the visits of each community, identified by its chiefdom and its name
+    ignoring case and whitespace.
+
+    Returns:
+        A DataFrame with one row per community: chiefdom_id, section_id (the section
+        most of its visits resolve to, or UNRESOLVED), name (the first spelling),
+        population, the cases of each kind and {kind}_counted, the same cases but
+        zero for communities without a population.
+    """
+    names = visits.community.fillna('').astype(str)
+    keys = names.map(lambda x: WHITESPACE.sub(' ', x).strip().lower())
+    codes, uniques = pd.factorize(pd.MultiIndex.from_arrays([visits.chiefdom_id, keys]))
+    n = len(uniques)
+    first = np.unique(codes, return_index=True)[1]
+
+    population = np.full(n, np.nan)
+    np.fmax.at(population, codes, visits.population.to_numpy(dtype='float64'))
+    counted = ~np.isnan(population)
+
+    communities = pd.DataFrame({
+        'chiefdom_id': visits.chiefdom_id.to_numpy()[first],
+        'section_id': majority(codes, visits.section_id.to_numpy(), n),
+        'name': names.to_numpy()[first],
+        'population': population,
+    })
+    for kind in CASE_PREFIXES:
+        cases = np.bincount(codes, weights=np.nan_to_num(visits[kind].to_numpy(dtype='float64')), minlength=n)
+        communities[kind] = cases
+        communities[f'{kind}_counted'] = np.where(counted, cases, 0.)
+    return communities
+
+
+def majority(codes, values, n):
+    """
+    Returns the most frequent value other than UNRESOLVED for each code, UNRESOLVED
+    for codes without one. Ties go to the larger value.
+    """
+    result = np.full(n, UNRESOLVED, dtype=np.int64)
+    known = values != UNRESOLVED
+    if not known.any():
+        return result
+
+    width = values.max() + 1
+    pairs, counts = np.unique(codes[known] * width + values[known], return_counts=True)
+    pair_codes, pair_values = np.divmod(pairs, width)
+    # Sorted by code and count, so the last pair of every code is its majority.
+    order = np.lexsort([counts, pair_codes])
+    result[pair_codes[order]] = pair_values[order]
+    return result
+
+
+def chiefdom_table(communities):
+    """
+    Sums the communities of every chiefdom that has at least one.
+    """
+    chiefdom_ids, codes = np.unique(communities.chiefdom_id.to_numpy(), return_inverse=True)
+    chiefdoms = pd.DataFrame({'chiefdom_id': chiefdom_ids})
+    chiefdoms['population'] = np.bincount(codes, weights=np.nan_to_num(communities.population), minlength=len(chiefdom_ids))
+    for kind in CASE_PREFIXES:
+        for col in [kind, f'{kind}_counted']:
+            chiefdoms[col] = np.bincount(codes, weights=communities[col], minlength=len(chiefdom_ids))
+    return chiefdoms
+
+
+def unit_quantities(units):
+    """
+    Returns the QUANTITIES of each unit (a community or chiefdom) as a float64 matrix.
+    """
+    population = np.nan_to_num(units.population.to_numpy(dtype='float64'))
+    rated = population > 0
+    counted = [units[f'{kind}_counted'].to_numpy(dtype='float64') for kind in CASE_PREFIXES]
+    rates = [np.divide(cases, population, out=np.zeros(len(units)), where=rated) for cases in counted]
+    return np.column_stack([np.ones(len(units)), rated.astype('float64'), population] + counted + rates)
+
+
+def level_groups(communities, chiefdoms):
+    """
+    Assigns the units of every level to the locations of that level.
+
+    Returns:
+        A dictionary mapping each of LEVELS to a tuple of the quantities of its units,
+        the location code of every unit (0..n_locations-1) and an Index labelling the
+        locations.
+    """
+    community_quantities = unit_quantities(communities)
+    chiefdom_quantities = unit_quantities(chiefdoms)
+    chiefdom_names = GAZETTEER.decode('chiefdom', communities.chiefdom_id)
+
+    groups = {'community': (
+        community_quantities,
+        np.arange(len(communities)),
+        pd.MultiIndex.from_arrays([chiefdom_names, communities.name], names=['chiefdom', 'community']),
+    )}
+
+    section_ids = communities.section_id.to_numpy()
+    resolved = section_ids != UNRESOLVED
+    sections, codes = np.unique(section_ids[resolved], return_inverse=True)
+    groups['section'] = (
+        community_quantities[resolved],
+        codes,
+        pd.MultiIndex.from_arrays([
+            GAZETTEER.decode('chiefdom', GAZETTEER.parent('section', sections)),
+            GAZETTEER.decode('section', sections),
+        ], names=['chiefdom', 'section']),
+    )
+
+    chiefdom_ids, codes = np.unique(communities.chiefdom_id.to_numpy(), return_inverse=True)
+    groups['chiefdom'] = (
+        community_quantities,
+        codes,
+        pd.Index(GAZETTEER.decode('chiefdom', chiefdom_ids), name='chiefdom'),
+    )
+
+    for level in ['district', 'province']:
+        ids, codes = np.unique(GAZETTEER.ancestor('chiefdom', chiefdoms.chiefdom_id.to_numpy(), level), return_inverse=True)
+        groups[level] = (chiefdom_quantities, codes, pd.Index(GAZETTEER.decode(level, ids), name=level))
+    return groups
+
+
+def group_matrix(groups):
+    """
+    Stacks the units of every level into a sparse matrix with one row per unit and
+    level and one column per location and quantity, holding the quantities of the
+    unit in the columns of its location. Summing the rows, or any weighted
+    combination of them, therefore sums every location of every level at once.
+
+    Returns:
+        A tuple of the CSR matrix, the location of every row and the offsets of the
+        locations of each level, level i has locations offsets[i]..offsets[i + 1] - 1.
+    """
+    k = len(QUANTITIES)
+    offsets = np.cumsum([0] + [len(labels) for _, _, labels in groups.values()])
+    codes = np.concatenate([codes + offset for (_, codes, _), offset in zip(groups.values(), offsets)])
+    quantities = np.concatenate([quantities for quantities, _, _ in groups.values()])
+
+    rows = np.repeat(np.arange(len(codes)), k)
+    cols = (codes[:, None] * k + np.arange(k)).ravel()
+    matrix = scipy.sparse.csr_matrix((quantities.ravel(), (rows, cols)), shape=(len(codes), offsets[-1] * k))
+    return matrix, codes, offsets
+
+
+def bootstrap_bounds(matrix, codes, totals, n_bootstrap, confidence, batch_size, seed):
+    """
+    Resamples the units of every location with replacement and returns the
+    percentile intervals of the rates, see rate_arrays.
+
+    Args:
+        matrix, codes: The result of group_matrix.
+        totals: The sums of QUANTITIES of every location.
+
+    Returns:
+        An array of shape (2, n_locations, n_rates) with the lower and upper bounds,
+        NaN for locations with a single unit.
+    """
+    k = len(QUANTITIES)
+    n_units = totals[:, 0].astype(np.int64)
+
+    # Only locations with several units vary between replicates, the rows of their
+    # units are sorted by location so that a unit is drawn from the range of its own.
+    resampled = np.flatnonzero(n_units > 1)
+    rows = np.flatnonzero(n_units[codes] > 1)
+    rows = rows[np.argsort(codes[rows], kind='stable')]
+    sizes = n_units[codes[rows]].astype(np.int32)
+    starts = np.searchsorted(codes[rows], codes[rows]).astype(np.int32)
+    cols = (resampled[:, None] * k + np.arange(k)).ravel()
+    sub_matrix = matrix[rows][:, cols].T.tocsr()
+
+    # Draws are made in float32 and int32, which halves the memory traffic of the
+    # largest arrays. A draw can round up to the size of its location, hence the
+    # clipping.
+    rng = np.random.default_rng(seed)
+    replicates = np.empty((n_bootstrap, len(resampled), n_rates()), dtype=np.float32)
+    bases = starts + np.arange(batch_size, dtype=np.int32)[:, None] * np.int32(len(rows))
+    for start in range(0, n_bootstrap, batch_size):
+        n = min(batch_size, n_bootstrap - start)
+        draws = (rng.random((n, len(rows)), dtype=np.float32) * sizes.astype(np.float32)).astype(np.int32)
+        np.minimum(draws, sizes - 1, out=draws)
+        draws += bases[:n]
+        counts = np.bincount(draws.ravel(), minlength=n * len(rows)).reshape(n, len(rows))
+        sums = (sub_matrix @ counts.T.astype(np.float64)).T.reshape(n, len(resampled), k)
+        replicates[start:start + n] = rate_arrays(sums)
+
+    bounds = np.full((2, len(totals), n_rates()), np.nan)
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    # nanquantile goes column by column, so it is only used for the rates that are
+    # undefined in some replicate, e.g. when every resampled unit lacks a population.
+    flat = replicates.reshape(n_bootstrap, -1)
+    undefined = np.isnan(flat).any(axis=0)
+    flat_bounds = np.empty((2, flat.shape[1]))
+    flat_bounds[:, ~undefined] = np.quantile(flat[:, ~undefined], quantiles, axis=0)
+    if undefined.any():
+        with warnings.catch_warnings():
+            # Rates that are undefined in every replicate stay NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            flat_bounds[:, undefined] = np.nanquantile(flat[:, undefined], quantiles, axis=0)
+    bounds[:, resampled] = flat_bounds.reshape(2, len(resampled), n_rates())
+    return bounds
+
+
+def n_rates():
+    return 2 * len(CASE_PREFIXES)
+
+
+def rate_arrays(sums):
+    """
+    Turns sums of QUANTITIES, in the last axis, into the people and unit rate of
+    each kind of case, in the order of rate_columns.
+    """
+    rated_units, population = sums[..., 1], sums[..., 2]
+    n_kinds = len(CASE_PREFIXES)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        people = sums[..., 3:3 + n_kinds] / population[..., None]
+        unit = sums[..., 3 + n_kinds:] / rated_units[..., None]
+    return np.stack([people, unit], axis=-1).reshape(sums.shape[:-1] + (n_rates(), ))
+
+
+def rate_columns():
+    return [f'{kind}_{rate}_rate' for kind in CASE_PREFIXES for rate in ['people', 'unit']]
+
+
+def rate_frame(totals, bounds, labels):
+    """
+    Returns the QUANTITIES and the rates of the locations of one level, with the
+    bounds of the rates when given.
+    """
+    df = pd.DataFrame(totals, index=labels, columns=QUANTITIES)
+    df[['units', 'rated_units']] = df[['units', 'rated_units']].astype(np.int64)
+
+    rates = rate_arrays(totals)
+    for j, col in enumerate(rate_columns()):
+        df[col] = rates[:, j]
+        if bounds is not None:
+            stem = col[:-len('_rate')]
+            df[f'{stem}_lower'] = bounds[0, :, j]
+            df[f'{stem}_upper'] = bounds[1, :, j]
+    return df
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
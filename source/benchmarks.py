@@ -0,0 +1,519 @@
+"""
+Benchmarks of the ETL and analysis pipeline.
+
+Each benchmark is a function registered with @benchmark that receives a context
+(the data directory of the current scale and a scratch directory) and returns a
+tuple of (setup, run). setup is called before every repetition and is not timed,
+its result is passed to run, which is. Benchmarks marked scaled run against the
+bundled data and against synthetically scaled copies of it, in which every sheet
+holds its rows repeated scale times. The copies keep the distinct values of the
+bundled data, so they measure how the pipeline scales with the number of rows
+rather than with the number of distinct values.
+
+Results are written as JSON to results_path, named after the commit and time of
+the run, and two result files can be compared with --compare, e.g.
+    python benchmarks.py --scales 1 10
+    python benchmarks.py --compare ../data/benchmarks/a.json ../data/benchmarks/b.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cache
+import etl
+
+SOURCE_PATH = Path(__file__).resolve().parent
+
+# Registry of name -> (function, scaled), filled by @benchmark
+BENCHMARKS = dict()
+
+# Text column whose spelling correction map is benchmarked, it has few distinct values.
+SPELLING_COLUMN = ('Trigger_Other', 't_q4')
+SPELLING_SAMPLES = 200
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the SMAC ETL and analysis pipeline.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--benchmarks',
+        nargs='+',
+        default=None,
+        help=f'Benchmarks to run, all of them by default: {", ".join(BENCHMARKS)}.',
+    )
+    parser.add_argument(
+        '--compare',
+        nargs=2,
+        default=None,
+        metavar=('BASELINE', 'CANDIDATE'),
+        help='Compares two result files instead of running the benchmarks.',
+    )
+    parser.add_argument(
+        '--data_path',
+        type=str,
+        default='../data',
+        help='Directory holding the clean and raw sheets the benchmarks run against.',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Number of timed repetitions of every benchmark.',
+    )
+    parser.add_argument(
+        '--results_path',
+        type=str,
+        default='../data/benchmarks',
+        help='Directory the JSON results are written to.',
+    )
+    parser.add_argument(
+        '--scales',
+        type=int,
+        nargs='+',
+        default=[1, 10],
+        help='Row multipliers of the synthetic copies of the data, 1 is the data itself.',
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.2,
+        help='With --compare, ratios of the median times above this are reported as regressions.',
+    )
+    parser.add_argument(
+        '--work_path',
+        type=str,
+        default='../data/cache/benchmarks',
+        help='Scratch directory for the scaled data and the caches of the benchmarks.',
+    )
+
+    return parser
+
+
+def main(
+        benchmarks=None,
+        compare=None,
+        data_path='../data',
+        repeat=5,
+        results_path='../data/benchmarks',
+        scales=(1, 10),
+        threshold=1.2,
+        work_path='../data/cache/benchmarks',
+):
+    if compare is not None:
+        report_comparison(*compare, threshold=threshold)
+        return
+
+    results = run_benchmarks(
+        names=benchmarks,
+        data_path=data_path,
+        scales=scales,
+        repeat=repeat,
+        work_path=work_path,
+    )
+    path = save_results(results, results_path)
+    print(f'Results written to {path}')
+
+
+def benchmark(name, scaled=True):
+    def register(function):
+        BENCHMARKS[name] = (function, scaled)
+        return function
+    return register
+
+
+def run_benchmarks(names=None, data_path='../data', scales=(1, 10), repeat=5, work_path='../data/cache/benchmarks'):
+    """
+    Runs the benchmarks, the scaled ones once per scale. A benchmark that runs out of
+    memory at some scale is recorded as failed, with an error instead of times, and
+    the others carry on.
+
+    Returns:
+        A list of result dictionaries, see time_benchmark.
+    """
+    names = names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f'Unknown benchmarks: {", ".join(sorted(unknown))}!')
+
+    results = []
+    for scale in scales:
+        if scale == 1:
+            scale_data_path = Path(data_path)
+        else:
+            scale_data_path = make_scaled_data(scale, data_path=data_path, output_path=Path(work_path) / f'x{scale}')
+
+        for name in names:
+            function, scaled = BENCHMARKS[name]
+            if not scaled and scale != min(scales):
+                continue
+
+            scratch_path = Path(work_path) / 'scratch' / f'{name}_x{scale}'
+            if scratch_path.exists():
+                shutil.rmtree(scratch_path)
+            scratch_path.mkdir(parents=True)
+
+            context = {'data_path': scale_data_path, 'scratch_path': scratch_path}
+            try:
+                result = time_benchmark(name, function(context), repeat=repeat)
+            except MemoryError:
+                result = {'name': name, 'repeat': repeat, 'error': 'MemoryError'}
+            result['scale'] = scale if scaled else None
+            results.append(result)
+            if 'error' in result:
+                print(f'{name} (x{scale}): failed with {result["error"]}')
+            else:
+                print(f'{name} (x{scale}): median {result["median"]:.4f}s, min {result["min"]:.4f}s')
+
+    return results
+
+
+def time_benchmark(name, setup_and_run, repeat=5):
+    """
+    Times repeat calls of run, each after an untimed call of setup.
+
+    Returns:
+        A dictionary with the name, all of the times and their min, median and mean.
+    """
+    setup, run = setup_and_run
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else None
+        start = time.perf_counter()
+        run(args)
+        times.append(time.perf_counter() - start)
+
+    return {
+        'name': name,
+        'repeat': repeat,
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+    }
+
+
+def make_scaled_data(scale, data_path='../data', output_path='../data/cache/benchmarks/x10'):
+    """
+    Writes copies of the clean and raw sheet CSVs whose rows are repeated scale times.
+    The Codebook and the column maps are copied unchanged. Existing copies are reused
+    as long as the files they were made from are unchanged.
+
+    Returns:
+        The output path, which can be passed as data_path to etl.load_smac_data.
+    """
+    output_path = Path(output_path)
+    manifest_path = output_path / 'manifest.json'
+    sources = {
+        f'{data_kind}/{path.name}': path
+        for data_kind in ('clean', 'raw')
+        for path in etl.sheet_paths(data_kind, data_path=data_path).values()
+    }
+    sources.update({
+        f'column_maps/{path.name}': path
+        for path in sorted((Path(data_path) / 'column_maps').glob('*_map.json'))
+    })
+
+    if manifest_path.is_file():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('scale') == scale and manifest['sources'].keys() == sources.keys() and all(
+            cache.signature_matches(path, manifest['sources'][key])[0]
+            for key, path in sources.items()
+        ):
+            return output_path
+
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    for key, path in sources.items():
+        target = output_path / key
+        target.parent.mkdir(exist_ok=True, parents=True)
+        if key.startswith('column_maps/') or etl.sheet_name_from_path(path) == 'Codebook':
+            shutil.copyfile(path, target)
+            continue
+
+        with open(path, newline='') as f:
+            header = f.readline()
+            body = f.read()
+        if body and not body.endswith('\n'):
+            body += '\n'
+        with open(target, 'w', newline='') as f:
+            f.write(header)
+            for _ in range(scale):
+                f.write(body)
+
+    # The manifest is written last so that an interrupted run is never reused.
+    with open(manifest_path, 'w') as f:
+        json.dump(
+            {'scale': scale, 'sources': {key: cache.file_signature(path) for key, path in sources.items()}},
+            f,
+            indent=4,
+            sort_keys=True,
+        )
+    return output_path
+
+
+def save_results(results, results_path='../data/benchmarks'):
+    """
+    Writes the results along with the commit and environment they were measured in.
+
+    Returns:
+        The path of the JSON file.
+    """
+    commit = git_commit()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    path = Path(results_path) / f'{timestamp}_{commit[:10]}.json'
+    path.parent.mkdir(exist_ok=True, parents=True)
+
+    with open(path, 'w') as f:
+        json.dump(
+            {
+                'commit': commit,
+                'timestamp': timestamp,
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'cpu_count': os.cpu_count(),
+                    'numpy': np.__version__,
+                    'pandas': pd.__version__,
+                },
+                'results': results,
+            },
+            f,
+            indent=4,
+            sort_keys=True,
+        )
+    return path
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, candidate):
+    """
+    Matches the results of two runs by name and scale, failed results are left out.
+
+    Returns:
+        A DataFrame with the median time of each run and their ratio, candidate over
+        baseline, for the benchmarks present in both.
+    """
+    def medians(run):
+        return {
+            (result['name'], result['scale']): result['median']
+            for result in run['results']
+            if 'error' not in result
+        }
+
+    baseline, candidate = medians(baseline), medians(candidate)
+    rows = [
+        {
+            'name': name,
+            'scale': scale,
+            'baseline': baseline[(name, scale)],
+            'candidate': candidate[(name, scale)],
+            'ratio': candidate[(name, scale)] / baseline[(name, scale)],
+        }
+        for name, scale in baseline.keys() & candidate.keys()
+    ]
+    columns = ['name', 'scale', 'baseline', 'candidate', 'ratio']
+    comparison = pd.DataFrame(rows, columns=columns).astype({'scale': 'Int64'})
+    return comparison.sort_values(['name', 'scale'], na_position='first')
+
+
+def report_comparison(baseline_path, candidate_path, threshold=1.2):
+    baseline, candidate = load_results(baseline_path), load_results(candidate_path)
+    comparison = compare_results(baseline, candidate)
+
+    print(f'Baseline:  {baseline["commit"][:10]} ({baseline["timestamp"]})')
+    print(f'Candidate: {candidate["commit"][:10]} ({candidate["timestamp"]})')
+    with pd.option_context('display.precision', 4):
+        print(comparison.to_string(index=False))
+
+    regressions = comparison[comparison.ratio > threshold]
+    if len(regressions):
+        print(f'\n{len(regressions)} regressions above {threshold:.2f}x:')
+        for row in regressions.itertuples():
+            print(f'\t{row.name} (x{row.scale}): {row.ratio:.2f}x')
+    return comparison
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=SOURCE_PATH,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def time_import(module):
+    """
+    Returns the seconds a fresh interpreter takes to import module, less the time it
+    takes to start without importing anything.
+    """
+    def elapsed(code):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=SOURCE_PATH, check=True)
+        return time.perf_counter() - start
+
+    return elapsed(f'import {module}') - elapsed('pass')
+
+
+@benchmark('import_etl', scaled=False)
+def bench_import_etl(context):
+    return None, lambda _: time_import('etl')
+
+
+@benchmark('import_sierra_leone', scaled=False)
+def bench_import_sierra_leone(context):
+    return None, lambda _: time_import('sierra_leone')
+
+
+def load_all(**kwargs):
+    dfs = etl.load_smac_data(**kwargs)
+    return {sheet: dfs[sheet] for sheet in dfs}
+
+
+@benchmark('load_smac_data_csv')
+def bench_load_smac_data_csv(context):
+    def run(_):
+        load_all(data_kind='raw', use_cache=False, data_path=context['data_path'])
+    return None, run
+
+
+@benchmark('load_smac_data_cached')
+def bench_load_smac_data_cached(context):
+    cache_path = context['scratch_path'] / 'cache'
+    load_all(data_kind='raw', cache_path=cache_path, data_path=context['data_path'])
+
+    def run(_):
+        load_all(data_kind='raw', cache_path=cache_path, data_path=context['data_path'])
+    return None, run
+
+
+def copy_column_maps(context):
+    """
+    Copies the column maps of the data directory to the scratch directory, so that
+    cleaning neither reads nor writes the maps and bundle of the repo, and compiles
+    their bundle there.
+
+    Returns:
+        Keyword arguments of etl.clean_smac_data for the copies.
+    """
+    map_path = context['scratch_path'] / 'column_maps'
+    shutil.copytree(Path(context['data_path']) / 'column_maps', map_path)
+    kwargs = {'map_path': map_path, 'bundle_path': context['scratch_path'] / 'cache' / 'column_maps.pkl'}
+    etl.load_column_maps(path=kwargs['map_path'], bundle_path=kwargs['bundle_path'])
+    return kwargs
+
+
+@benchmark('clean_smac_data')
+def bench_clean_smac_data(context):
+    cache_path = context['scratch_path'] / 'cache'
+    map_kwargs = copy_column_maps(context)
+
+    def setup():
+        return load_all(cache_path=cache_path, data_path=context['data_path'])
+
+    def run(dfs):
+        etl.clean_smac_data(dfs, **map_kwargs)
+    return setup, run
+
+
+@benchmark('make_spelling_correction_map')
+def bench_make_spelling_correction_map(context):
+    """
+    Spell checks every distinct value of SPELLING_COLUMN with an empty spelling cache.
+    """
+    sheet, col = SPELLING_COLUMN
+    dfs = etl.load_smac_data(data_kind='raw', usecols=[col], use_cache=False, data_path=context['data_path'])
+    dfs = {sheet: dfs[sheet]}
+    etl.get_spell_checker()
+
+    def setup():
+        path = context['scratch_path'] / 'spelling.sqlite'
+        path.unlink(missing_ok=True)
+        return etl.get_spelling_cache(path)
+
+    def run(spelling_cache):
+        with spelling_cache:
+            etl.make_spelling_correction_map(
+                dfs,
+                sheet,
+                col,
+                spelling_cache=spelling_cache,
+                processes=1,
+                output_path=context['scratch_path'],
+            )
+    return setup, run
+
+
+@benchmark('fix_spelling_errors', scaled=False)
+def bench_fix_spelling_errors(context):
+    """
+    Spell checks the first SPELLING_SAMPLES distinct values of SPELLING_COLUMN.
+    """
+    sheet, col = SPELLING_COLUMN
+    dfs = etl.load_smac_data(data_kind='raw', usecols=[col], use_cache=False, data_path=context['data_path'])
+    samples = sorted(dfs[sheet][col].dropna().str.lower().str.strip().unique())[:SPELLING_SAMPLES]
+    etl.get_spell_checker()
+
+    def run(_):
+        for sample in samples:
+            etl.fix_spelling_errors(sample)
+    return None, run
+
+
+@benchmark('validate_locations')
+def bench_validate_locations(context):
+    dfs = load_all(
+        data_kind='raw',
+        usecols=etl.LOCATION_COLUMNS,
+        cache_path=context['scratch_path'] / 'cache',
+        data_path=context['data_path'],
+    )
+
+    def run(_):
+        etl.validate_locations(dfs, data_kind='raw', output_path=context['scratch_path'])
+    return None, run
+
+
+@benchmark('get_sheet_stats')
+def bench_get_sheet_stats(context):
+    from data_cleanup_analysis import get_sheet_stats
+
+    cache_path = context['scratch_path'] / 'cache'
+    raw = load_all(data_kind='raw', compact=False, cache_path=cache_path, data_path=context['data_path'])
+    clean_1 = load_all(data_kind='clean', compact=False, cache_path=cache_path, data_path=context['data_path'])
+    clean_2 = etl.clean_smac_data(
+        load_all(data_kind='clean', compact=False, cache_path=cache_path, data_path=context['data_path']),
+        **copy_column_maps(context),
+    )
+
+    def run(_):
+        for sheet in etl.CLEANED_SHEETS:
+            get_sheet_stats(raw[sheet], clean_1[sheet], clean_2[sheet])
+    return None, run
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
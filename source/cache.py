@@ -0,0 +1,277 @@
+"""
+Helpers for persisting intermediate results under data/cache and deciding when
+they have gone stale.
+
+Cached artifacts are keyed on a signature of their source files (size, mtime and
+a content digest). The size and mtime are checked first since they are cheap,
+and the digest is only recomputed when they disagree, so touching a file without
+changing it (e.g. a git checkout) does not throw away a valid cache.
+"""
+
+import hashlib
+import json
+import pickle
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+# Bump this whenever the on-disk layout of cached frames changes.
+CACHE_VERSION = 1
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_signature(path):
+    path = Path(path)
+    stat = path.stat()
+    return {
+        'name': path.name,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': file_digest(path),
+    }
+
+
+def signature_matches(path, signature):
+    """
+    Checks whether the file at path still matches a previously recorded signature.
+
+    Args:
+        path: The file to check.
+        signature: A dictionary produced by file_signature.
+
+    Returns:
+        A tuple of (matches, refreshed) where refreshed is True when the content
+        is unchanged but the mtime moved, meaning the stored signature should be
+        rewritten to keep subsequent checks cheap.
+    """
+    path = Path(path)
+    if not path.is_file() or not signature:
+        return False, False
+
+    stat = path.stat()
+    if stat.st_size != signature.get('size'):
+        return False, False
+    if stat.st_mtime_ns == signature.get('mtime_ns'):
+        return True, False
+    return file_digest(path) == signature.get('sha1'), True
+
+
+def save_frame(df, path, manifest):
+    """
+    Persists a DataFrame as one pickle per column so that individual columns can
+    be read back without deserializing the whole sheet.
+
+    Args:
+        df: The DataFrame to persist.
+        path: Directory that will hold the column files and manifest.
+        manifest: Dictionary of metadata (typically the source signature) that is
+            stored alongside the columns and returned by load_manifest.
+    """
+    path = Path(path)
+    if path.exists():
+        shutil.rmtree(path)
+    path.mkdir(parents=True)
+
+    columns = list(df.columns)
+    for i, col in enumerate(columns):
+        with open(path / f'{i:04d}.pkl', 'wb') as f:
+            pickle.dump(df[col], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # The manifest is written last so that an interrupted save is never mistaken
+    # for a complete one.
+    manifest = dict(manifest, version=CACHE_VERSION, columns=columns, n_rows=len(df))
+    with open(path / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def load_manifest(path):
+    path = Path(path) / 'manifest.json'
+    if not path.is_file():
+        return None
+
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != CACHE_VERSION:
+        return None
+    return manifest
+
+
+def update_manifest(path, **kwargs):
+    manifest = load_manifest(path)
+    manifest.update(kwargs)
+    with open(Path(path) / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def load_frame(path, usecols=None, manifest=None):
+    path = Path(path)
+    manifest = manifest or load_manifest(path)
+    columns = manifest['columns']
+    if usecols is None:
+        usecols = columns
+
+    series = dict()
+    for col in usecols:
+        with open(path / f'{columns.index(col):04d}.pkl', 'rb') as f:
+            series[col] = pickle.load(f)
+
+    return pd.DataFrame(series, columns=list(usecols))
+
+
+class SpellingCache:
+    """
+    A persistent store of spelling corrections shared by every column, sheet and run.
+
+    Corrections are keyed on the normalized input string plus a key describing the
+    spell checker parameters, so changing the dictionaries or thresholds never serves
+    stale corrections. The time each correction took is stored alongside it, which
+    gives an estimate of the time saved by every cache hit.
+    """
+    def __init__(self, path='../data/cache/spelling.sqlite', params=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.params = json.dumps(params or dict(), sort_keys=True)
+        self.stats = {'hits': 0, 'misses': 0, 'seconds_saved': 0., 'seconds_spent': 0.}
+
+        self._connection = sqlite3.connect(str(self.path))
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS corrections ('
+            'params TEXT NOT NULL, '
+            'sample TEXT NOT NULL, '
+            'correction TEXT NOT NULL, '
+            'seconds REAL NOT NULL, '
+            'PRIMARY KEY (params, sample))'
+        )
+
+    def get_many(self, samples):
+        """
+        Returns:
+            A dictionary of sample -> correction for the samples that are cached.
+        """
+        found = dict()
+        cursor = self._connection.cursor()
+        samples = list(samples)
+        # Stay below SQLite's limit on the number of bound parameters.
+        for i in range(0, len(samples), 500):
+            batch = samples[i:i + 500]
+            cursor.execute(
+                f'SELECT sample, correction, seconds FROM corrections '
+                f'WHERE params = ? AND sample IN ({", ".join("?" * len(batch))})',
+                [self.params] + batch,
+            )
+            for sample, correction, seconds in cursor.fetchall():
+                found[sample] = correction
+                self.stats['seconds_saved'] += seconds
+
+        self.stats['hits'] += len(found)
+        self.stats['misses'] += len(samples) - len(found)
+        return found
+
+    def put_many(self, corrections):
+        """
+        Args:
+            corrections: Iterable of (sample, correction, seconds) tuples.
+        """
+        corrections = [(self.params, x, y, t) for x, y, t in corrections]
+        self.stats['seconds_spent'] += sum(t for *_, t in corrections)
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO corrections VALUES (?, ?, ?, ?)',
+                corrections,
+            )
+
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def frame_digest(df):
+    """
+    Returns a digest of the content of a DataFrame (values, index and column names).
+    """
+    digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    digest.update(json.dumps([str(col) for col in df.columns]).encode())
+    return digest.hexdigest()
+
+
+class BuildState:
+    """
+    Records what each stage of an incremental build consumed and produced, so that a
+    rerun can skip the stages whose inputs are unchanged.
+
+    A stage is described by the files it reads, a JSON serializable dictionary of
+    values (parameters, digests of upstream results) and the files it writes. It is
+    fresh when the files still match their recorded signatures, the values are equal
+    and the outputs still exist unchanged. Checking only stats the files unless their
+    mtime moved, see signature_matches.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.stages = dict()
+        self._dirty = False
+
+        if self.path.is_file():
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('version') == CACHE_VERSION:
+                self.stages = state['stages']
+
+    def is_fresh(self, stage, files=(), values=None, outputs=()):
+        record = self.stages.get(stage)
+        if record is None or record['values'] != json.loads(json.dumps(values)):
+            return False
+        if sorted(record['files']) != sorted(str(path) for path in files):
+            return False
+        if sorted(record['outputs']) != sorted(str(path) for path in outputs):
+            return False
+
+        for signatures in (record['files'], record['outputs']):
+            for path, signature in signatures.items():
+                matches, refreshed = signature_matches(path, signature)
+                if not matches:
+                    return False
+                if refreshed:
+                    signatures[path] = file_signature(path)
+                    self._dirty = True
+        return True
+
+    def record(self, stage, files=(), values=None, outputs=(), **extra):
+        """
+        Marks a stage as built. Any extra keyword arguments (e.g. a digest of the
+        result) are stored with the stage and can be read back from stages[stage].
+        """
+        self.stages[stage] = dict(
+            extra,
+            values=json.loads(json.dumps(values)),
+            files={str(path): file_signature(path) for path in files},
+            outputs={str(path): file_signature(path) for path in outputs},
+        )
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'stages': self.stages}, f, indent=4, sort_keys=True)
+        tmp_path.replace(self.path)
+        self._dirty = False
@@ -0,0 +1,341 @@
+"""
+Community index across the SMAC sheets.
+
+Name_of_community is free text, so the trigger visit of a community and its follow
+ups often spell it differently ('Gbinti-Kabape', 'Gbinti Kabape', 'Gbinti Kabapeh').
+build_community_index links the spellings and gives every row a community_id:
+    1. Names are normalized with location_resolver.normalize_name.
+    2. Candidates are blocked by the resolved (chiefdom, section) of their rows and
+       found with the SymSpell deletes of location_resolver: two names are
+       candidates when they share a delete within the same chiefdom, which finds
+       every pair within the edit distance of max_distance without comparing all
+       pairs. Candidates are verified with osa_distance and names that differ in
+       their numbers ('Kpetema 1' and 'Kpetema 2') are never linked.
+    3. Names are clustered around the most common spellings: visiting the names
+       from the most to the least common, a name joins the closest more common name
+       of its block that started a community, or starts one itself. Rows whose
+       section is unresolved are visited last and may join a community of any
+       section of their chiefdom. Communities of different resolved sections are
+       never merged, even when they have the same name.
+
+The community_id is derived from the chiefdom, the section and the most common
+normalized spelling of a community, so it does not depend on the order of the
+rows or sheets and only changes when that spelling does. Rows without a name or
+with an unresolved chiefdom get UNRESOLVED.
+"""
+
+import argparse
+import hashlib
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import etl
+from gazetteer import GAZETTEER, UNRESOLVED
+from location_resolver import deletes, normalize_name, osa_distance
+
+COMMUNITY_SHEETS = ['Trigger_Ave', 'Trigger_NA', 'Trigger_Other', 'Follow_Up', 'Follow_Up_Other']
+NAME_COLUMN = 'Name_of_community'
+
+DIGITS = re.compile(r'\d+')
+
+
+def get_parser():
+    def parse_bool(x):
+        return x.lower() in ('t', 'true', '1', 'y', 'yes')
+
+    parser = argparse.ArgumentParser(
+        description='Links the spellings of Name_of_community across the SMAC sheets.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--data_kind',
+        type=str,
+        default='clean',
+        choices=['clean', 'raw'],
+        help='Data set to use.',
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default='../data/column_discrepancies',
+        help='Directory the community index is written to.',
+    )
+    parser.add_argument(
+        '--verbose',
+        type=parse_bool,
+        default=False,
+        help='Print the time taken and the communities with the most spellings.',
+    )
+
+    return parser
+
+
+def main(data_kind='clean', output_path='../data/column_discrepancies', verbose=False):
+    dfs = etl.clean_smac_data(etl.load_smac_data(data_kind), location_ids=True)
+
+    start = time.perf_counter()
+    index = add_community_ids(dfs)
+    rows = sum(len(dfs[sheet]) for sheet in COMMUNITY_SHEETS)
+    linked = sum((dfs[sheet].community_id != UNRESOLVED).sum() for sheet in COMMUNITY_SHEETS)
+    print(
+        f'Linked {linked} of {rows} rows to {len(index)} communities in {time.perf_counter() - start:.2f}s, '
+        f'{(index.trigger_rows > 0).sum()} of them with a trigger visit and '
+        f'{((index.trigger_rows > 0) & (index.follow_up_rows > 0)).sum()} with both a trigger and a follow up visit'
+    )
+    if verbose:
+        with pd.option_context('display.width', 160, 'display.max_colwidth', 60):
+            print(index.sort_values('variants', ascending=False).head(20))
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    index.to_csv(output_path / f'{data_kind}_community_index.csv')
+
+
+def add_community_ids(dfs, sheets=COMMUNITY_SHEETS):
+    """
+    Adds a community_id column to each of the sheets, see build_community_index.
+
+    Returns:
+        The community index.
+    """
+    index, ids = build_community_index(dfs, sheets=sheets)
+    for sheet, community_ids in ids.items():
+        dfs[sheet]['community_id'] = community_ids
+    return index
+
+
+def build_community_index(dfs, sheets=COMMUNITY_SHEETS):
+    """
+    Links the community names of the sheets, see the module docstring.
+
+    Args:
+        dfs: The cleaned sheets, with or without location IDs.
+        sheets: The sheets to link, those missing from dfs are skipped.
+
+    Returns:
+        A tuple of the index and a dictionary mapping each sheet to an int64 array
+        with the community_id of every row. The index is a DataFrame indexed by
+        community_id with the chiefdom, section (None when unresolved), name (the
+        most common spelling), the number of distinct normalized spellings, the
+        number of rows and the number of trigger and follow up rows.
+    """
+    sheets = [sheet for sheet in sheets if sheet in dfs]
+    mentions = mention_table(dfs, sheets)
+    linkable = (mentions.chiefdom_id.to_numpy() != UNRESOLVED) & (mentions.key.to_numpy() != '')
+
+    # Every distinct (chiefdom, section, key) is a node, the communities are groups
+    # of nodes.
+    nodes, node_codes = unique_nodes(mentions[linkable])
+    pairs = candidate_pairs(nodes)
+    communities = link_nodes(nodes, pairs)
+
+    canonical = canonical_keys(nodes, communities)
+    community_ids = np.array([
+        stable_id(chiefdom_id, section_id, key)
+        for chiefdom_id, section_id, key in zip(canonical.chiefdom_id, canonical.section_id, canonical.key)
+    ], dtype=np.int64)
+
+    row_ids = np.full(len(mentions), UNRESOLVED, dtype=np.int64)
+    row_ids[linkable] = community_ids[communities[node_codes]]
+
+    index = community_index(mentions, row_ids, canonical, community_ids, nodes, communities)
+    bounds = np.cumsum([0] + [len(dfs[sheet]) for sheet in sheets])
+    ids = {sheet: row_ids[bounds[i]:bounds[i + 1]] for i, sheet in enumerate(sheets)}
+    return index, ids
+
+
+def mention_table(dfs, sheets):
+    """
+    Returns one row per row of the sheets with its chiefdom and section IDs, the raw
+    name, its normalized key and whether it is a trigger row.
+    """
+    mentions = []
+    for sheet in sheets:
+        df = dfs[sheet]
+        ids = df if 'chiefdom_id' in df.columns else etl.add_location_ids(df[['District', 'Chiefdom', 'Section']].copy())
+        names = df[NAME_COLUMN].fillna('').astype(str)
+        codes, uniques = pd.factorize(names)
+        keys = np.array([normalize_name(name) for name in uniques] + [''], dtype=object)
+        mentions.append(pd.DataFrame({
+            'chiefdom_id': ids.chiefdom_id.to_numpy(dtype=np.int64),
+            'section_id': ids.section_id.to_numpy(dtype=np.int64),
+            'name': names.str.strip().to_numpy(),
+            'key': keys[codes],
+            'trigger': sheet.startswith('Trigger'),
+        }))
+    return pd.concat(mentions, ignore_index=True)
+
+
+def unique_nodes(mentions):
+    """
+    Returns the distinct (chiefdom_id, section_id, key) of the mentions with their
+    number of rows, and the node of every mention.
+    """
+    grouped = mentions.groupby(['chiefdom_id', 'section_id', 'key'], sort=False)
+    return grouped.size().rename('rows').reset_index(), grouped.ngroup().to_numpy()
+
+
+def candidate_pairs(nodes):
+    """
+    Finds the pairs of nodes of the same chiefdom whose keys are within the allowed
+    edit distance. Pairs of different resolved sections are left out since they are
+    never linked.
+
+    Returns:
+        A DataFrame with the nodes a < b of every pair and the distance of their keys.
+    """
+    keys = pd.Series(nodes.key.unique())
+    variants = keys.map(lambda key: tuple(deletes(key, max_distance(key)))).explode()
+    key_variants = pd.DataFrame({'key': keys[variants.index].to_numpy(), 'variant': variants.to_numpy()})
+
+    node_variants = nodes[['chiefdom_id', 'section_id', 'key']].reset_index(names='node').merge(key_variants, on='key')
+    pairs = node_variants.merge(node_variants, on=['chiefdom_id', 'variant'], suffixes=('_a', '_b'))
+    pairs = pairs[
+        (pairs.node_a < pairs.node_b) &
+        (
+            (pairs.section_id_a == pairs.section_id_b) |
+            (pairs.section_id_a == UNRESOLVED) |
+            (pairs.section_id_b == UNRESOLVED)
+        )
+    ]
+    pairs = pairs.drop_duplicates(['node_a', 'node_b'])
+
+    # Each distinct pair of keys is only verified once.
+    key_pairs = pairs[['key_a', 'key_b']].drop_duplicates()
+    distances = [key_distance(a, b) for a, b in zip(key_pairs.key_a, key_pairs.key_b)]
+    key_pairs = key_pairs.assign(distance=distances)
+    pairs = pairs.merge(key_pairs, on=['key_a', 'key_b'])
+    pairs = pairs[pairs.distance.notna()]
+    return pairs[['node_a', 'node_b', 'distance']].reset_index(drop=True)
+
+
+def max_distance(key):
+    """
+    Returns the edit distance allowed for a key. Community names are short and often
+    differ in a single letter ('Makondo', 'Matondo'), so this is stricter than for
+    chiefdoms and sections in location_resolver.max_distance_for.
+    """
+    if len(key) <= 4:
+        return 0
+    if len(key) <= 9:
+        return 1
+    return 2
+
+
+def key_distance(a, b):
+    """
+    Returns the edit distance of two keys, or None when they are too far apart to be
+    the same community.
+    """
+    if a == b:
+        return 0
+    if DIGITS.findall(a) != DIGITS.findall(b):
+        return None
+    allowed = min(max_distance(a), max_distance(b))
+    distance = osa_distance(a, b, allowed)
+    return distance if distance <= allowed else None
+
+
+def link_nodes(nodes, pairs):
+    """
+    Groups the nodes into communities around their most common spellings, see the
+    module docstring.
+
+    Returns:
+        An int64 array with the community of every node, numbered from 0.
+    """
+    n = len(nodes)
+    unresolved = nodes.section_id.to_numpy() == UNRESOLVED
+
+    # Nodes are visited with resolved sections first and by decreasing number of
+    # rows, the names and IDs only break ties so that the order of the rows does not
+    # matter.
+    order = nodes.assign(unresolved=unresolved).sort_values(
+        ['unresolved', 'rows', 'chiefdom_id', 'section_id', 'key'],
+        ascending=[True, False, True, True, True],
+    ).index.to_numpy()
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+
+    # Every pair in both directions, a node can only join a node visited before it
+    # and a node of a resolved section never joins one of an unresolved section.
+    a, b = pairs.node_a.to_numpy(), pairs.node_b.to_numpy()
+    edges = pd.DataFrame({
+        'node': np.concatenate([a, b]),
+        'center': np.concatenate([b, a]),
+        'distance': np.concatenate([pairs.distance.to_numpy()] * 2),
+    })
+    edges['center_rank'] = rank[edges.center.to_numpy()]
+    edges['center_unresolved'] = unresolved[edges.center.to_numpy()]
+    edges = edges[
+        (edges.center_rank.to_numpy() < rank[edges.node.to_numpy()]) &
+        (unresolved[edges.node.to_numpy()] | ~edges.center_unresolved.to_numpy())
+    ]
+    edges = edges.sort_values(['node', 'distance', 'center_unresolved', 'center_rank'])
+    nodes_with_edges, starts = np.unique(edges.node.to_numpy(), return_index=True)
+    candidates = dict(zip(nodes_with_edges, np.split(edges.center.to_numpy(), starts[1:])))
+
+    # A node joins the closest center among its candidates, or becomes a center. Only
+    # comparing with centers keeps chains of similar names (Makondo, Matondo,
+    # Matombo) from collapsing into one community.
+    centers = np.full(n, -1, dtype=np.int64)
+    for node in order:
+        centers[node] = node
+        for center in candidates.get(node, ()):
+            if centers[center] == center:
+                centers[node] = center
+                break
+    return pd.factorize(centers)[0].astype(np.int64)
+
+
+def canonical_keys(nodes, communities):
+    """
+    Returns the chiefdom, section and most common key of every community. The
+    section is the resolved one of the community, if any.
+    """
+    keyed = nodes.assign(community=communities)
+    key_rows = keyed.groupby(['community', 'key'], sort=False).rows.sum().reset_index()
+    key_rows = key_rows.sort_values(['community', 'rows', 'key'], ascending=[True, False, True])
+    canonical = key_rows.drop_duplicates('community').set_index('community').key.sort_index()
+
+    return pd.DataFrame({
+        'chiefdom_id': keyed.groupby('community').chiefdom_id.first().sort_index(),
+        'section_id': keyed.groupby('community').section_id.max().sort_index(),
+        'key': canonical,
+    })
+
+
+def stable_id(chiefdom_id, section_id, key):
+    """
+    Returns a non-negative int64 derived from the chiefdom and section names and the
+    key, so that the same community gets the same ID whatever the other rows.
+    """
+    section = '' if section_id == UNRESOLVED else GAZETTEER.names['section'][section_id]
+    text = f'{GAZETTEER.names["chiefdom"][chiefdom_id]}|{section}|{key}'
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+def community_index(mentions, row_ids, canonical, community_ids, nodes, communities):
+    linked = mentions[row_ids != UNRESOLVED].assign(community_id=row_ids[row_ids != UNRESOLVED])
+    names = linked.groupby(['community_id', 'name']).size().rename('rows').reset_index()
+    names = names.sort_values(['community_id', 'rows', 'name'], ascending=[True, False, True])
+
+    index = pd.DataFrame({
+        'chiefdom': GAZETTEER.decode('chiefdom', canonical.chiefdom_id.to_numpy()),
+        'section': GAZETTEER.decode('section', canonical.section_id.to_numpy()),
+        'variants': nodes.assign(community=communities).groupby('community').key.nunique().sort_index().to_numpy(),
+    }, index=pd.Index(community_ids, name='community_id'))
+    index['name'] = names.drop_duplicates('community_id').set_index('community_id').name
+    index['rows'] = linked.groupby('community_id').size()
+    index['trigger_rows'] = linked[linked.trigger].groupby('community_id').size()
+    index['follow_up_rows'] = linked[~linked.trigger].groupby('community_id').size()
+    index[['trigger_rows', 'follow_up_rows']] = index[['trigger_rows', 'follow_up_rows']].fillna(0).astype(np.int64)
+    return index[['chiefdom', 'section', 'name', 'variants', 'rows', 'trigger_rows', 'follow_up_rows']]
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
@@ -0,0 +1,500 @@
+"""
+Dense time-series cube of the SMAC counts, indexed by (period, location, metric).
+
+build_cube makes one pass over the cleaned sheets and sums every metric per week
+and chiefdom into a NumPy array:
+    - trigger_visits, follow_up_visits: the number of visits (rows).
+    - trigger_{col}, follow_up_{col}: the count columns ss_*, r_*, d_*, b_* and cb_*
+      of the trigger and follow up visits, missing counts add nothing.
+    - bylaw_reports: trigger visits that reported at least one by-law (t_q9).
+    - bylaws: the number of by-laws listed in those reports, see count_bylaws.
+
+Trigger_Ave and Trigger_NA hold the same visits, they only differ in how missing
+population totals were filled in, so the trigger counts come from TRIGGER_SHEET
+alone. Weeks start on Mondays. Rows without a date are left out of the cube and
+rows whose chiefdom is not in the gazetteer go to a trailing UNRESOLVED_LABEL
+location.
+
+Roll-ups to districts, provinces, months or sex/age groups are reductions of the
+array, see SMACCube.rollup, and the cube is stored as a single .npz file.
+
+New visits are added with SMACCube.append, which cleans a batch of rows with the
+cached column maps and adds them to the cells they fall in. The weeks are kept in
+a buffer that grows geometrically, so the cost of an append depends on the size
+of the batch rather than on the length of the history.
+"""
+
+import argparse
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import etl
+from gazetteer import GAZETTEER, UNRESOLVED
+
+# Bump this whenever the metrics or the layout of the .npz change.
+CUBE_VERSION = 1
+
+TRIGGER_SHEET = 'Trigger_NA'
+DATE_COLUMNS = {
+    'Trigger_Ave': 'Trig_date',
+    'Trigger_NA': 'Trig_date',
+    'Trigger_Other': 'Trig_date',
+    'Follow_Up': 'Date_of_visit',
+    'Follow_Up_Other': 'Date_of_Visit',
+}
+COUNT_PREFIXES = ['ss', 'r', 'd', 'b', 'cb']
+DEMOGRAPHICS = ['mc', 'fc', 'ma', 'fa']
+COUNT_COLUMNS = [f'{prefix}_{demographic}' for prefix in COUNT_PREFIXES for demographic in DEMOGRAPHICS]
+DEMOGRAPHIC_GROUPS = {
+    'sex': {'m': ['mc', 'ma'], 'f': ['fc', 'fa']},
+    'age': {'c': ['mc', 'fc'], 'a': ['ma', 'fa']},
+    'total': {'all': DEMOGRAPHICS},
+}
+METRICS = (
+    ['trigger_visits', 'follow_up_visits', 'bylaw_reports', 'bylaws'] +
+    [f'trigger_{col}' for col in COUNT_COLUMNS] +
+    [f'follow_up_{col}' for col in COUNT_COLUMNS]
+)
+
+LOCATION_LEVELS = ('chiefdom', 'district', 'province')
+PERIODS = ('week', 'month')
+UNRESOLVED_LABEL = 'Unresolved'
+
+# By-laws are listed as free text, separated by punctuation or numbering.
+BYLAW_SEPARATORS = re.compile(r'[,;.\n/]+|\band\b|\(?\b\d+\s*[).-]')
+BYLAW_WORD = re.compile(r'[a-z]{3,}')
+NO_BYLAW_ANSWERS = {'0', 'no', 'none', 'nil', 'n/a', 'na', 'nothing'}
+
+
+def get_parser():
+    def parse_bool(x):
+        return x.lower() in {'true', 't', '1'}
+
+    parser = argparse.ArgumentParser(
+        description='Builds the week x chiefdom x metric cube of the cleaned SMAC data.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--append_csv',
+        type=str,
+        default=None,
+        help='CSV of new rows of --append_sheet to clean and add to the cube at --output_path, '
+             'instead of building the cube from scratch.',
+    )
+    parser.add_argument(
+        '--append_sheet',
+        type=str,
+        default=None,
+        choices=list(DATE_COLUMNS),
+        help='Sheet the rows of --append_csv belong to.',
+    )
+    parser.add_argument(
+        '--data_kind',
+        type=lambda x: x.lower(),
+        default='clean',
+        choices=['clean', 'raw'],
+        help='Determines the data flavor that is loaded and cleaned.',
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default='../data/cache/cube.npz',
+        help='File the cube is written to.',
+    )
+    parser.add_argument(
+        '--verbose',
+        type=parse_bool,
+        default=False,
+        help='Print a summary of the cube.',
+    )
+
+    return parser
+
+
+def main(append_csv=None, append_sheet=None, data_kind='clean', output_path='../data/cache/cube.npz', verbose=False):
+    if append_csv is not None:
+        cube = SMACCube.load(output_path)
+        rows = cube.append(append_sheet, pd.read_csv(append_csv, parse_dates=[DATE_COLUMNS[append_sheet]]))
+        cube.save(output_path)
+        if verbose:
+            print(f'Added {len(rows)} rows of {append_sheet} to {cube}')
+        return
+
+    dfs = etl.clean_smac_data(etl.load_smac_data(data_kind=data_kind))
+    cube = build_cube(dfs)
+    cube.save(output_path)
+
+    if verbose:
+        print(cube)
+        print(cube.rollup(location='province', period='month', demographic='total').to_frame())
+
+
+class SMACCube:
+    """
+    Args:
+        values: Array of shape (periods, locations, metrics).
+        periods: datetime64[D] array with the first day of every period.
+        locations: Names of the locations, the last one is UNRESOLVED_LABEL.
+        metrics: Names of the metrics.
+        level: Location level, one of LOCATION_LEVELS.
+        period: One of PERIODS.
+    """
+    def __init__(self, values, periods, locations, metrics, level='chiefdom', period='week'):
+        self._buffer = np.asarray(values)
+        self._periods = np.asarray(periods, dtype='datetime64[D]')
+        self._n_periods = len(self._periods)
+        self.locations = tuple(locations)
+        self.metrics = tuple(metrics)
+        self.level = level
+        self.period = period
+
+        expected = (len(self.periods), len(self.locations), len(self.metrics))
+        if self.values.shape != expected:
+            raise ValueError(f'Expected values of shape {expected}, got {self.values.shape}!')
+
+    @property
+    def values(self):
+        return self._buffer[:self._n_periods]
+
+    @property
+    def periods(self):
+        return self._periods[:self._n_periods]
+
+    def __repr__(self):
+        return (
+            f'{type(self).__name__}({len(self.periods)} {self.period}s x {len(self.locations)} {self.level}s '
+            f'x {len(self.metrics)} metrics)'
+        )
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                version=CUBE_VERSION,
+                values=self.values,
+                periods=self.periods,
+                locations=np.array(self.locations),
+                metrics=np.array(self.metrics),
+                level=self.level,
+                period=self.period,
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            if int(f['version']) != CUBE_VERSION:
+                raise ValueError(f'{path} was written by cube version {int(f["version"])}, expected {CUBE_VERSION}!')
+            return cls(
+                f['values'],
+                f['periods'],
+                f['locations'].tolist(),
+                f['metrics'].tolist(),
+                level=str(f['level']),
+                period=str(f['period']),
+            )
+
+    def append(self, sheet, rows, maps=None):
+        """
+        Cleans a batch of new rows of a sheet and adds them to the cube in place.
+        Only the cells the rows fall in are touched. Dates past the last week extend
+        the cube, dates before the first week are rejected.
+
+        Args:
+            sheet: Name of the sheet the rows belong to, sheets that do not feed the
+                cube (e.g. Trigger_Ave) are cleaned but leave the cube unchanged.
+            rows: DataFrame of new rows, with the columns of the sheet as read by
+                etl.load_smac_data. It is not modified.
+            maps: Column maps as returned by etl.load_column_maps, loaded from the
+                compiled bundle when None. Pass them in when appending many batches.
+
+        Returns:
+            The cleaned rows.
+        """
+        if self.level != 'chiefdom' or self.period != 'week':
+            raise ValueError('Only a cube of weeks and chiefdoms can be appended to!')
+
+        maps = maps if maps is not None else etl.load_column_maps()
+        rows = etl.clean_smac_sheet(sheet, rows.copy(), maps)
+        metrics = metric_columns(sheet, rows)
+        if metrics is None:
+            return rows
+
+        # Rows without a valid date are left out, as they are by add_to_cube. The others
+        # are checked before the cube is extended so that a rejected batch leaves it as is.
+        dates = parse_dates(rows[DATE_COLUMNS[sheet]]).dropna()
+        if len(dates) and week_start(dates.min()) < self.periods[0]:
+            raise ValueError(f'Dates of {DATE_COLUMNS[sheet]} fall before the first week of the cube!')
+        if len(dates):
+            self._reserve(week_start(dates.max()))
+        add_to_cube(self.values, rows, DATE_COLUMNS[sheet], self.periods[0], metrics, list(self.metrics))
+        return rows
+
+    def _reserve(self, last_week):
+        """
+        Extends the cube up to last_week. The buffer at least doubles whenever it is
+        full so that adding weeks one at a time costs amortized constant time.
+        """
+        n_periods = int((last_week - self._periods[0]).astype(np.int64) // 7) + 1
+        if n_periods <= self._n_periods:
+            return
+
+        if n_periods > len(self._buffer):
+            capacity = max(n_periods, 2 * len(self._buffer))
+            buffer = np.zeros((capacity, ) + self._buffer.shape[1:], dtype=self._buffer.dtype)
+            buffer[:self._n_periods] = self.values
+            self._buffer = buffer
+            self._periods = self._periods[0] + 7 * np.arange(capacity).astype('timedelta64[D]')
+        self._n_periods = n_periods
+
+    def select(self, metrics):
+        """
+        Returns a cube with only the given metrics.
+        """
+        index = [self.metrics.index(metric) for metric in metrics]
+        return SMACCube(self.values[:, :, index], self.periods, self.locations, metrics, self.level, self.period)
+
+    def rollup(self, location=None, period=None, demographic=None):
+        """
+        Aggregates the cube to coarser locations, periods or demographic groups. Each
+        is a grouped sum along one axis of the array, see aggregate_axis.
+
+        Args:
+            location: 'district' or 'province', only from a finer level.
+            period: 'month', only from weeks. A week counts towards the month of its
+                first day.
+            demographic: 'sex', 'age' or 'total', sums the count metrics over the
+                demographic suffixes in DEMOGRAPHIC_GROUPS, e.g. trigger_ss_mc and
+                trigger_ss_ma become trigger_ss_m. Other metrics are kept as is.
+
+        Returns:
+            A new SMACCube.
+        """
+        cube = self
+        if location is not None and location != cube.level:
+            cube = cube._rollup_locations(location)
+        if period is not None and period != cube.period:
+            cube = cube._rollup_periods(period)
+        if demographic is not None:
+            cube = cube._rollup_demographics(demographic)
+        return cube
+
+    def _rollup_locations(self, level):
+        if LOCATION_LEVELS.index(level) < LOCATION_LEVELS.index(self.level):
+            raise ValueError(f'Cannot roll {self.level}s up to {level}s!')
+
+        ids = np.array([GAZETTEER.ids[self.level].get(name, UNRESOLVED) for name in self.locations[:-1]])
+        parent_ids = GAZETTEER.ancestor(self.level, ids, level)
+        names = GAZETTEER.names[level]
+        # The unresolved location stays unresolved.
+        codes = np.append(np.where(parent_ids == UNRESOLVED, len(names), parent_ids), len(names))
+        values = aggregate_axis(self.values, codes, len(names) + 1, axis=1)
+        return SMACCube(values, self.periods, names + (UNRESOLVED_LABEL, ), self.metrics, level, self.period)
+
+    def _rollup_periods(self, period):
+        if period != 'month' or self.period != 'week':
+            raise ValueError(f'Cannot roll {self.period}s up to {period}s!')
+
+        months = self.periods.astype('datetime64[M]')
+        unique_months, codes = np.unique(months, return_inverse=True)
+        values = aggregate_axis(self.values, codes, len(unique_months), axis=0)
+        return SMACCube(values, unique_months.astype('datetime64[D]'), self.locations, self.metrics, self.level, period)
+
+    def _rollup_demographics(self, demographic):
+        groups = DEMOGRAPHIC_GROUPS[demographic]
+        metrics = []
+        for metric in self.metrics:
+            stem, _, suffix = metric.rpartition('_')
+            if suffix in DEMOGRAPHICS:
+                group = next(name for name, suffixes in groups.items() if suffix in suffixes)
+                metric = f'{stem}_{group}'
+            metrics.append(metric)
+
+        unique_metrics = list(dict.fromkeys(metrics))
+        codes = np.array([unique_metrics.index(metric) for metric in metrics])
+        values = aggregate_axis(self.values, codes, len(unique_metrics), axis=2)
+        return SMACCube(values, self.periods, self.locations, unique_metrics, self.level, self.period)
+
+    def series(self, metric, location=None):
+        """
+        Returns the time series of a metric, for one location or summed over all of them.
+        """
+        values = self.values[:, :, self.metrics.index(metric)]
+        if location is None:
+            values = values.sum(axis=1)
+        else:
+            values = values[:, self.locations.index(location)]
+        return pd.Series(values, index=pd.DatetimeIndex(self.periods, name=self.period), name=metric)
+
+    def to_frame(self):
+        """
+        Returns the cube as a long DataFrame with one row per period and location, and
+        one column per metric.
+        """
+        index = pd.MultiIndex.from_product(
+            [pd.DatetimeIndex(self.periods), self.locations],
+            names=[self.period, self.level],
+        )
+        return pd.DataFrame(self.values.reshape(-1, len(self.metrics)), index=index, columns=list(self.metrics))
+
+
+def aggregate_axis(values, codes, n_groups, axis):
+    """
+    Sums the entries of values along axis that share a code, codes has one entry per
+    position along axis.
+    """
+    codes = np.asarray(codes)
+    shape = list(values.shape)
+    shape[axis] = n_groups
+    result = np.zeros(shape, dtype=values.dtype)
+    if len(codes) == 0:
+        return result
+
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sums = np.add.reduceat(np.take(values, order, axis=axis), starts, axis=axis)
+
+    index = [slice(None)] * values.ndim
+    index[axis] = sorted_codes[starts]
+    result[tuple(index)] = sums
+    return result
+
+
+def build_cube(dfs, metrics=METRICS):
+    """
+    Sums every metric per week and chiefdom in one pass over each sheet.
+
+    Args:
+        dfs: Dictionary of cleaned sheets, as returned by clean_smac_data. A
+            chiefdom_id column (see add_location_ids) is used when present.
+        metrics: Names of the metrics, see METRICS.
+
+    Returns:
+        A SMACCube of weeks x chiefdoms x metrics.
+    """
+    sources = cube_sources(dfs)
+    dates = [parse_dates(df[DATE_COLUMNS[sheet]]) for sheet, (df, _) in sources.items()]
+    first = min(date.min() for date in dates if date.notna().any())
+    last = max(date.max() for date in dates if date.notna().any())
+    origin = week_start(first)
+    periods = np.arange(origin, week_start(last) + np.timedelta64(1, 'W'), np.timedelta64(7, 'D'))
+
+    values = np.zeros((len(periods), len(GAZETTEER.names['chiefdom']) + 1, len(metrics)), dtype=np.int64)
+    for sheet, (df, sheet_metrics) in sources.items():
+        add_to_cube(values, df, DATE_COLUMNS[sheet], origin, sheet_metrics, list(metrics))
+
+    locations = GAZETTEER.names['chiefdom'] + (UNRESOLVED_LABEL, )
+    return SMACCube(values, periods, locations, metrics)
+
+
+def cube_sources(dfs):
+    """
+    Returns:
+        A dictionary of sheet -> (sheet, dictionary of metric -> column of values).
+    """
+    return {
+        sheet: (dfs[sheet], metric_columns(sheet, dfs[sheet]))
+        for sheet in [TRIGGER_SHEET, 'Follow_Up', 'Trigger_Other']
+    }
+
+
+def metric_columns(sheet, df):
+    """
+    Returns:
+        A dictionary of metric -> column of values for the rows of a sheet, or None
+        if the sheet does not feed the cube.
+    """
+    if sheet in {TRIGGER_SHEET, 'Follow_Up'}:
+        prefix = 'trigger' if sheet == TRIGGER_SHEET else 'follow_up'
+        metrics = {f'{prefix}_visits': pd.Series(1, index=df.index)}
+        metrics.update({f'{prefix}_{col}': df[col] for col in COUNT_COLUMNS if col in df.columns})
+        return metrics
+
+    if sheet == 'Trigger_Other':
+        bylaws = count_bylaws(df.t_q9)
+        return {'bylaw_reports': bylaws > 0, 'bylaws': bylaws}
+    return None
+
+
+def add_to_cube(values, df, date_column, origin, sheet_metrics, metrics):
+    """
+    Adds the metrics of one sheet (or a batch of its rows) to values in place. The
+    rows are summed per distinct (week, chiefdom) cell first, so only the cells they
+    fall in are updated.
+
+    Args:
+        values: Array of weeks x chiefdoms (+ unresolved) x metrics.
+        df: The sheet.
+        date_column: Name of the date column the week is derived from.
+        origin: First day of the first week of values.
+        sheet_metrics: Dictionary of metric -> column of values of df.
+        metrics: Names of the metrics along the last axis of values.
+    """
+    n_weeks, n_locations, _ = values.shape
+    dates = parse_dates(df[date_column]).to_numpy(dtype='datetime64[D]')
+    present = ~np.isnat(dates)
+    weeks = (dates[present] - origin).astype(np.int64) // 7
+    if len(weeks) and (weeks.min() < 0 or weeks.max() >= n_weeks):
+        raise ValueError(f'Dates of {date_column} fall outside of the weeks of the cube!')
+
+    chiefdom_ids = chiefdom_codes(df)[present]
+    cells = weeks * n_locations + np.where(chiefdom_ids == UNRESOLVED, n_locations - 1, chiefdom_ids)
+    cells, codes = np.unique(cells, return_inverse=True)
+    cell_weeks, cell_locations = np.divmod(cells, n_locations)
+    for metric, column in sheet_metrics.items():
+        weights = pd.Series(column).to_numpy(dtype='float64', na_value=0.)[present]
+        sums = np.bincount(codes, weights=weights, minlength=len(cells))
+        values[cell_weeks, cell_locations, metrics.index(metric)] += np.rint(sums).astype(values.dtype)
+
+
+def chiefdom_codes(df):
+    if 'chiefdom_id' in df.columns:
+        return df.chiefdom_id.to_numpy(dtype=np.int64)
+    return GAZETTEER.encode('chiefdom', df.Chiefdom).astype(np.int64)
+
+
+def parse_dates(dates):
+    """
+    Returns a date column as datetime64, NaT where a value is missing or malformed
+    (the raw sheets hold dates like '`01/15/2015'). Such rows are left out of the cube.
+    """
+    return pd.to_datetime(dates, errors='coerce')
+
+
+def week_start(date):
+    """
+    Returns the Monday of the week of date as datetime64[D].
+    """
+    day = np.datetime64(pd.Timestamp(date).date(), 'D')
+    # 1970-01-01 was a Thursday, so Mondays are 4 days after a multiple of 7.
+    return day - (day.astype(np.int64) - 4) % 7
+
+
+def count_bylaws(answers):
+    """
+    Counts the by-laws listed in each answer to t_q9. An answer is split on
+    punctuation, 'and' and numbering, and every part with a word of at least three
+    letters counts as one by-law. Answers like 'none' count as zero. The answers
+    are parsed once per distinct value.
+
+    Returns:
+        An int64 array.
+    """
+    codes, uniques = pd.factorize(answers)
+    counts = np.zeros(len(uniques) + 1, dtype=np.int64)
+    for i, answer in enumerate(uniques):
+        answer = str(answer).strip().lower()
+        if answer in NO_BYLAW_ANSWERS:
+            continue
+        counts[i] = sum(BYLAW_WORD.search(part) is not None for part in BYLAW_SEPARATORS.split(answer))
+    # Missing answers have code -1 and take the trailing zero.
+    return counts[codes]
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
@@ -1,3 +1,4 @@
+import time
 from collections import Counter
 from pathlib import Path
 
@@ -5,34 +6,100 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
-from etl import load_smac_data, clean_smac_data
+import cache
+from edit_log import column_diff, compose_edits, diff_edits, edit_counts, load_edit_log, make_edit_log, save_edit_log
+from etl import load_smac_data, clean_smac_data, sheet_paths
 
 
 def main():
-    raw_data = load_smac_data('raw')
-    clean_data_1 = load_smac_data('clean')
-    clean_data_2 = clean_smac_data(load_smac_data('clean'))
+    timings = dict()
+    manual_log, auto_log, shapes = get_edit_logs(timings=timings)
 
-    sheet_stats = dict()
-    for key in raw_data.keys():
-        if key in {'Codebook', 'digital'}:
-            continue
-
-        raw_sheet = raw_data[key]
-        clean_1_sheet = clean_data_1[key]
-        clean_2_sheet = clean_data_2[key]
-
-        sheet_stats[key] = get_sheet_stats(raw_sheet, clean_1_sheet, clean_2_sheet)
+    start = time.perf_counter()
+    sheet_stats = get_sheet_stats_from_logs(manual_log, auto_log, shapes)
     global_stats = calculate_global_stats(sheet_stats)
+    timings['Statistics'] = time.perf_counter() - start
 
     with pd.option_context('display.precision', 2):
         report(global_stats, sheet_stats)
 
+    start = time.perf_counter()
     make_column_bar_figure(
         sheet_stats,
         filter_upper=100.,
         filter_lower=1.,
     )
+    timings['Figure'] = time.perf_counter() - start
+
+    display_timings(timings)
+
+
+def get_edit_logs(cache_path='../data/cache', map_path='../data/column_maps', timings=None):
+    """
+    Returns the manual edits (raw to clean data) and the automated edits (clean_smac_data
+    on the clean data) as edit logs, see edit_log.py. The logs are kept under
+    cache_path/analysis and only rebuilt when the sheets, the column maps or the
+    cleaning code change, in which case each dataset is loaded once: the manual edits
+    are diffed first and the clean data is then cleaned in place.
+
+    Args:
+        cache_path: Directory of the cached logs and their build state.
+        map_path: Directory of the column maps used by clean_smac_data.
+        timings: Optional dictionary, the seconds spent on each phase are added to it.
+
+    Returns:
+        A tuple of the manual log, the automated log and a dictionary of sheet ->
+        (number of rows, list of column names).
+    """
+    timings = timings if timings is not None else dict()
+    state = cache.BuildState(Path(cache_path) / 'build' / 'analysis.json')
+    source_path = Path(__file__).resolve().parent
+    code_files = [source_path / name for name in ['edit_log.py', 'etl.py', 'schemas.py']]
+    raw_files = list(sheet_paths('raw').values())
+    clean_files = list(sheet_paths('clean').values())
+    map_files = sorted(Path(map_path).glob('*_map.json'))
+    manual_path = Path(cache_path) / 'analysis' / 'manual'
+    auto_path = Path(cache_path) / 'analysis' / 'auto'
+
+    manual_files = raw_files + clean_files + code_files
+    auto_files = clean_files + map_files + code_files
+    manual_fresh = state.is_fresh('manual', manual_files, outputs=[manual_path / 'manifest.json'])
+    auto_fresh = state.is_fresh('auto', auto_files, outputs=[auto_path / 'manifest.json'])
+
+    start = time.perf_counter()
+    if manual_fresh and auto_fresh:
+        manual_log, auto_log = load_edit_log(manual_path), load_edit_log(auto_path)
+        shapes = {sheet: tuple(shape) for sheet, shape in state.stages['manual']['shapes'].items()}
+        timings['Load Edit Logs'] = time.perf_counter() - start
+        return manual_log, auto_log, shapes
+
+    raw_data = load_smac_data('raw', compact=False)
+    clean_data = load_smac_data('clean', compact=False)
+    sheets = [key for key in raw_data.keys() if key not in {'Codebook', 'digital'}]
+    shapes = {sheet: (len(clean_data[sheet]), list(clean_data[sheet].columns)) for sheet in sheets}
+    timings['Load Data'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    manual_log = make_edit_log([
+        diff_edits(sheet, raw_data[sheet], clean_data[sheet], rule='manual')
+        for sheet in sheets
+    ])
+    del raw_data
+    save_edit_log(manual_log, manual_path)
+    state.record('manual', manual_files, outputs=[manual_path / 'manifest.json'], shapes=shapes)
+    timings['Manual Edits'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    auto_edits = []
+    clean_smac_data(clean_data, edits=auto_edits)
+    del clean_data
+    auto_log = make_edit_log(auto_edits)
+    save_edit_log(auto_log, auto_path)
+    state.record('auto', auto_files, outputs=[auto_path / 'manifest.json'])
+    timings['Automated Edits'] = time.perf_counter() - start
+
+    state.save()
+    return manual_log, auto_log, shapes
 
 
 def calculate_global_stats(name2sheet_stats):
@@ -52,25 +119,62 @@ def calculate_global_stats(name2sheet_stats):
     return dict(global_stats)
 
 
-def get_sheet_stats(raw_sheet, clean_1_sheet, clean_2_sheet):
-    diff_1 = raw_sheet.values != clean_1_sheet.values
-    diff_2 = clean_1_sheet.values != clean_2_sheet.values
-    diff_3 = raw_sheet.values != clean_2_sheet.values
+def get_sheet_stats(raw_sheet, clean_1_sheet, clean_2_sheet, chunksize=None):
+    return summarize_sheet_edits(
+        diff_sheets(raw_sheet, clean_1_sheet, chunksize=chunksize),
+        diff_sheets(clean_1_sheet, clean_2_sheet, chunksize=chunksize),
+        diff_sheets(raw_sheet, clean_2_sheet, chunksize=chunksize),
+        list(raw_sheet.columns),
+    )
+
+
+def get_sheet_stats_from_logs(manual_log, auto_log, shapes):
+    """
+    Computes the same statistics as get_sheet_stats from edit logs, see edit_log.py.
+    The total edits are the manual edits followed by the automated ones.
+
+    Args:
+        manual_log: Edit log of the raw data to the clean data.
+        auto_log: Edit log of clean_smac_data on the clean data.
+        shapes: Dictionary of sheet -> (number of rows, list of column names).
 
-    n_rows = diff_1.shape[0]
-    n_cols = diff_1.shape[1]
-    n_values = np.prod(diff_1.shape)
+    Returns:
+        A dictionary of sheet -> statistics.
+    """
+    total_log = compose_edits(manual_log, auto_log)
 
-    n_manual_edits = diff_1.sum()
+    sheet_stats = dict()
+    for sheet, (n_rows, columns) in shapes.items():
+        sheet_stats[sheet] = summarize_sheet_edits(
+            *(edit_counts(log[log.Sheet == sheet], n_rows, columns) for log in (manual_log, auto_log, total_log)),
+            columns,
+        )
+    return sheet_stats
+
+
+def summarize_sheet_edits(manual_diffs, auto_diffs, total_diffs, col_labels):
+    """
+    Args:
+        manual_diffs: Tuple of the number of manual edits per row and per column.
+        auto_diffs: Same for the automated edits.
+        total_diffs: Same for the manual and automated edits combined.
+        col_labels: Column names of the sheet.
+    """
+    row_diff_1, col_diff_1 = manual_diffs
+    row_diff_2, col_diff_2 = auto_diffs
+    row_diff_3, col_diff_3 = total_diffs
+
+    n_rows = len(row_diff_1)
+    n_cols = len(col_diff_1)
+    n_values = n_rows * n_cols
+
+    n_manual_edits = col_diff_1.sum()
     n_manual_edits_rel = 100. * n_manual_edits / n_values
-    n_auto_edits = diff_2.sum()
+    n_auto_edits = col_diff_2.sum()
     n_auto_edits_rel = 100. * n_auto_edits / n_values
-    n_total_edits = diff_3.sum()
+    n_total_edits = col_diff_3.sum()
     n_total_edits_rel = 100. * n_total_edits / n_values
 
-    row_diff_1 = diff_1.sum(axis=1)
-    row_diff_2 = diff_2.sum(axis=1)
-    row_diff_3 = diff_3.sum(axis=1)
     row_manual = pd.Series(row_diff_1).describe()
     row_manual_rel = 100. * row_manual / n_cols
     row_auto = pd.Series(row_diff_2).describe()
@@ -90,9 +194,6 @@ def get_sheet_stats(raw_sheet, clean_1_sheet, clean_2_sheet):
         'Row Total Rel.',
     ]
 
-    col_diff_1 = diff_1.sum(axis=0)
-    col_diff_2 = diff_2.sum(axis=0)
-    col_diff_3 = diff_3.sum(axis=0)
     col_manual = pd.Series(col_diff_1).describe()
     col_manual_rel = 100. * col_manual / n_rows
     col_auto = pd.Series(col_diff_2).describe()
@@ -125,10 +226,42 @@ def get_sheet_stats(raw_sheet, clean_1_sheet, clean_2_sheet):
         'row_stats': row_stats,
         'col_stats': col_stats,
         'col_total_rel_vals': 100. * col_diff_3 / n_rows,
-        'col_labels': list(raw_sheet.columns),
+        'col_labels': list(col_labels),
     }
 
 
+def diff_sheets(sheet_a, sheet_b, chunksize=None, tolerance=1e-9):
+    """
+    Counts the values that differ between two versions of a sheet, comparing the
+    columns pairwise by position with column_diff. Only one column of one chunk of
+    rows is compared at a time, so memory stays proportional to the chunk rather
+    than the sheet.
+
+    Args:
+        sheet_a: The sheet before the edits.
+        sheet_b: The sheet after the edits, with the same shape as sheet_a.
+        chunksize: Number of rows compared at a time, all of them by default.
+        tolerance: Relative tolerance for numeric values, see column_diff.
+
+    Returns:
+        A tuple of arrays with the number of differing values per row and per column.
+    """
+    if sheet_a.shape != sheet_b.shape:
+        raise ValueError(f'Cannot diff sheets of shapes {sheet_a.shape} and {sheet_b.shape}!')
+
+    n_rows, n_cols = sheet_a.shape
+    chunksize = chunksize or max(n_rows, 1)
+    row_diff = np.zeros(n_rows, dtype=np.int64)
+    col_diff = np.zeros(n_cols, dtype=np.int64)
+    for start in range(0, n_rows, chunksize):
+        rows = slice(start, start + chunksize)
+        for j in range(n_cols):
+            differ = column_diff(sheet_a.iloc[rows, j], sheet_b.iloc[rows, j], tolerance=tolerance)
+            row_diff[rows] += differ
+            col_diff[j] += differ.sum()
+    return row_diff, col_diff
+
+
 def report(global_stats, name2sheet_stats):
     print('Meta-Analysis of Data Cleaning Efforts:')
     display_global_stats(global_stats)
@@ -165,6 +298,13 @@ def display_sheet_stats(sheet_name, sheet_stats):
     print()
 
 
+def display_timings(timings):
+    print('Phase Timings:')
+    for phase, seconds in timings.items():
+        print(f'\t{phase + ":":<17}{seconds:7.3f}s')
+    print()
+
+
 def display_describe(df, columns=None, tab_level=0, header=False, index=False):
     if columns is None:
         columns = ['mean', 'std', 'min', '25%', '50%', '75%', 'max']
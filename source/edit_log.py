@@ -0,0 +1,285 @@
+"""
+Cell level log of the edits made to the SMAC sheets.
+
+Every entry records the Sheet, Row (index label), Column, the Old and New value and
+the Rule that made the edit: the name of the column map that was applied, a named
+step of clean_smac_sheet (e.g. coerce_count) or 'manual' for the differences
+between the raw and the manually cleaned data. Only values that actually change
+are logged, see column_diff, so a log holds a few thousand rows rather than the
+hundreds of thousands of values in the sheets.
+
+A log is a DataFrame with EDIT_LOG_COLUMNS, the Sheet, Column and Rule columns are
+categories. It is stored with cache.save_frame, one file per column.
+"""
+
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cache
+
+EDIT_LOG_COLUMNS = ['Sheet', 'Row', 'Column', 'Old', 'New', 'Rule']
+CELL_COLUMNS = ['Sheet', 'Row', 'Column']
+CATEGORY_COLUMNS = ['Sheet', 'Column', 'Rule']
+
+NUMBER = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*')
+
+
+def log_edits(edits, sheet, col, before, after, rule):
+    """
+    Appends the values of a column that changed to an edit log.
+
+    Args:
+        edits: List of DataFrames the entries are appended to, nothing is done when
+            it is None.
+        sheet: Name of the sheet.
+        col: Name of the column.
+        before: The column before the rule was applied.
+        after: The column after the rule was applied, with the same index.
+        rule: Name of the rule.
+    """
+    if edits is None:
+        return
+
+    changed = column_diff(before, after)
+    if not changed.any():
+        return
+
+    edits.append(pd.DataFrame({
+        'Sheet': sheet,
+        'Row': before.index[changed],
+        'Column': col,
+        'Old': as_objects(before[changed]),
+        'New': as_objects(after[changed]),
+        'Rule': rule,
+    }))
+
+
+def diff_edits(sheet, sheet_a, sheet_b, rule):
+    """
+    Logs every value that differs between two versions of a sheet, comparing the
+    columns pairwise by position. Columns are named after sheet_b.
+
+    Returns:
+        An edit log.
+    """
+    if sheet_a.shape != sheet_b.shape:
+        raise ValueError(f'Cannot diff sheets of shapes {sheet_a.shape} and {sheet_b.shape}!')
+
+    edits = []
+    for j, col in enumerate(sheet_b.columns):
+        log_edits(edits, sheet, col, sheet_a.iloc[:, j], sheet_b.iloc[:, j], rule)
+    return make_edit_log(edits)
+
+
+def make_edit_log(edits):
+    """
+    Combines the DataFrames collected by log_edits into a single edit log.
+    """
+    log = pd.concat([pd.DataFrame(columns=EDIT_LOG_COLUMNS)] + list(edits), ignore_index=True)
+    log['Row'] = log.Row.astype(np.int64)
+    for col in CATEGORY_COLUMNS:
+        log[col] = log[col].astype('category')
+    return log
+
+
+def net_edits(log):
+    """
+    Reduces a log to one entry per cell, with the first Old and the last New value of
+    the cell and the last Rule. Cells whose edits cancel out are dropped. Cells that
+    were only edited once are already net edits and are returned unchanged.
+    """
+    repeated = log.duplicated(CELL_COLUMNS, keep=False).to_numpy()
+    if not repeated.any():
+        return log
+
+    edits = log[repeated]
+    first = edits.drop_duplicates(CELL_COLUMNS, keep='first')
+    last = edits.drop_duplicates(CELL_COLUMNS, keep='last')
+    old = first.set_index(CELL_COLUMNS).Old.reindex(pd.MultiIndex.from_frame(last[CELL_COLUMNS]))
+
+    net = last.assign(Old=old.to_numpy())
+    return make_edit_log([log[~repeated], net[column_diff(net.Old, net.New)]])
+
+
+def compose_edits(first, second):
+    """
+    Returns the net edits of applying the edits of first and then those of second,
+    e.g. the manual edits followed by the automated ones.
+    """
+    first, second = net_edits(first), net_edits(second)
+    keys_1, keys_2 = cell_keys(first, second)
+
+    # Position in second of the cell of every entry of first, -1 when it has none.
+    order = np.argsort(keys_2, kind='stable')
+    positions = np.searchsorted(keys_2, keys_1, sorter=order)
+    in_both = positions < len(order)
+    in_both[in_both] = keys_2[order[positions[in_both]]] == keys_1[in_both]
+    matches = order[positions[in_both]]
+
+    # Only cells edited by both can end up unchanged, e.g. an automated edit that
+    # reverts a manual one.
+    both = second.iloc[matches].assign(Old=first.Old.to_numpy()[in_both])
+    both = both[column_diff(both.Old, both.New)]
+
+    in_second = np.zeros(len(second), dtype=bool)
+    in_second[matches] = True
+    return make_edit_log([first[~in_both], second[~in_second], both])
+
+
+def cell_keys(*logs):
+    """
+    Returns an int64 key per entry of each log that identifies its cell, the keys are
+    comparable across the logs.
+    """
+    sheets = pd.Index(sorted(set().union(*(log.Sheet.astype(object).unique() for log in logs))))
+    columns = pd.Index(sorted(set().union(*(log.Column.astype(object).unique() for log in logs))))
+    n_rows = max((int(log.Row.max()) + 1 for log in logs if len(log)), default=1)
+
+    keys = []
+    for log in logs:
+        sheet_codes = log.Sheet.cat.set_categories(sheets).cat.codes.to_numpy(dtype=np.int64)
+        col_codes = log.Column.cat.set_categories(columns).cat.codes.to_numpy(dtype=np.int64)
+        keys.append((sheet_codes * len(columns) + col_codes) * n_rows + log.Row.to_numpy(dtype=np.int64))
+    return keys
+
+
+def edit_counts(log, n_rows, columns):
+    """
+    Counts the edited cells of one sheet.
+
+    Args:
+        log: Edit log of the sheet.
+        n_rows: Number of rows of the sheet, rows are assumed to be labelled 0..n_rows-1.
+        columns: Column names of the sheet.
+
+    Returns:
+        A tuple of arrays with the number of edited values per row and per column.
+    """
+    col_codes = log.Column.cat.set_categories(list(columns)).cat.codes.to_numpy(dtype=np.int64)
+    rows = log.Row.to_numpy(dtype=np.int64)
+    cells = np.unique((col_codes * n_rows + rows)[col_codes != -1])
+    row_diff = np.bincount(cells % n_rows, minlength=n_rows).astype(np.int64)
+    col_diff = np.bincount(cells // n_rows, minlength=len(columns)).astype(np.int64)
+    return row_diff, col_diff
+
+
+def save_edit_log(log, path, **manifest):
+    """
+    Writes an edit log with cache.save_frame, any keyword arguments are stored in the
+    manifest.
+    """
+    cache.save_frame(log, Path(path), manifest)
+
+
+def load_edit_log(path):
+    manifest = cache.load_manifest(path)
+    if manifest is None:
+        return None
+    return make_edit_log([cache.load_frame(path, manifest=manifest)])
+
+
+def column_diff(a, b, tolerance=1e-9):
+    """
+    Compares two columns row by row:
+        - missing values (NaN, None, NaT, NA) are equal to each other and differ from
+          anything else,
+        - numbers, including numeric strings such as '3' in an object column, are
+          equal within the relative tolerance whatever their dtype,
+        - anything else is compared through its string form.
+
+    Numeric and datetime columns are compared as arrays, other columns as arrays of
+    objects.
+
+    Returns:
+        A boolean array that is True where the values differ.
+    """
+    if is_plain_numeric(a) and is_plain_numeric(b):
+        x = a.to_numpy(dtype='float64', na_value=np.nan)
+        y = b.to_numpy(dtype='float64', na_value=np.nan)
+        x_missing, y_missing = np.isnan(x), np.isnan(y)
+        present = ~x_missing & ~y_missing
+        differ = x_missing != y_missing
+        differ[present] = ~np.isclose(x[present], y[present], rtol=tolerance, atol=0.)
+        return differ
+
+    if pd.api.types.is_datetime64_any_dtype(a) and pd.api.types.is_datetime64_any_dtype(b):
+        x_missing, y_missing = a.isna().to_numpy(), b.isna().to_numpy()
+        differ = x_missing != y_missing
+        present = ~x_missing & ~y_missing
+        differ[present] = a.to_numpy()[present] != b.to_numpy()[present]
+        return differ
+
+    # Identical objects compare equal in C, only the remaining rows need a closer look:
+    # missing values, numbers written differently ('3' vs 3.0) or values of different
+    # types. These are factorized together so that the number or string of each
+    # distinct value is only derived once.
+    x, y = as_objects(a), as_objects(b)
+    differ = x != y
+    rows = np.flatnonzero(differ)
+    if len(rows) == 0:
+        return differ
+
+    codes, uniques = pd.factorize(np.concatenate([x[rows], y[rows]]))
+    x, y = codes[:len(rows)], codes[len(rows):]
+    present = (x != -1) & (y != -1)
+    result = (x == -1) != (y == -1)
+
+    x, y = x[present], y[present]
+    needed = np.unique(np.concatenate([x, y]))
+    numbers = np.full(len(uniques), np.nan)
+    numbers[needed] = as_numbers(uniques[needed])
+    is_text = np.zeros(len(uniques), dtype=bool)
+    is_text[needed] = [type(value) is str for value in uniques[needed]]
+
+    # Two distinct strings always differ unless both are numbers.
+    present_result = np.ones(len(x), dtype=bool)
+    numeric = ~np.isnan(numbers[x]) & ~np.isnan(numbers[y])
+    present_result[numeric] = ~np.isclose(numbers[x[numeric]], numbers[y[numeric]], rtol=tolerance, atol=0.)
+    mixed = ~numeric & ~(is_text[x] & is_text[y])
+    if mixed.any():
+        texts = np.empty(len(uniques), dtype=object)
+        involved = np.unique(np.concatenate([x[mixed], y[mixed]]))
+        texts[involved] = [str(value) for value in uniques[involved]]
+        present_result[mixed] = texts[x[mixed]] != texts[y[mixed]]
+
+    result[present] = present_result
+    differ[rows] = result
+    return differ
+
+
+def as_objects(series):
+    """
+    Returns a column as an array of objects with NaN for missing values. Datetime and
+    timedelta columns are boxed once per distinct value rather than once per row.
+    """
+    if pd.api.types.is_object_dtype(series):
+        return series.to_numpy()
+    if pd.api.types.is_datetime64_any_dtype(series) or pd.api.types.is_timedelta64_dtype(series):
+        codes, uniques = pd.factorize(series)
+        return np.append(uniques.to_numpy(dtype=object), np.nan)[codes]
+    return series.to_numpy(dtype=object, na_value=np.nan)
+
+
+def is_plain_numeric(series):
+    return (
+        pd.api.types.is_numeric_dtype(series) and
+        not isinstance(series.dtype, pd.CategoricalDtype)
+    ) or pd.api.types.is_bool_dtype(series)
+
+
+def as_numbers(values):
+    """
+    Returns an array of objects as float64, NaN where a value is not a number.
+    Only the strings that look like numbers are parsed since pd.to_numeric is slow on
+    values it has to coerce.
+    """
+    numeric = np.array([
+        NUMBER.fullmatch(x) is not None if type(x) is str else isinstance(x, (int, float, np.number))
+        for x in values
+    ], dtype=bool)
+    numbers = np.full(len(values), np.nan)
+    numbers[numeric] = pd.to_numeric(values[numeric], errors='coerce')
+    return numbers
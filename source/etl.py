@@ -3,28 +3,38 @@
 
 import argparse
 import json
-from multiprocessing import Pool
+import pickle
+import shutil
+import time
+from collections.abc import MutableMapping
+from functools import lru_cache
+from multiprocessing import Pool, get_start_method
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-import pkg_resources
-from symspellpy import SymSpell
-
-import sierra_leone
-
-# Global spell checker configuration
-sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
-dictionary_path = pkg_resources.resource_filename(
-    "symspellpy",
-    "frequency_dictionary_en_82_765.txt",
-)
-bigram_path = pkg_resources.resource_filename(
-    "symspellpy",
-    "frequency_bigramdictionary_en_243_342.txt",
-)
-# term_index is the column of the term and count_index is the column of the term frequency
-sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
-sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
+
+import cache
+import schemas
+from edit_log import log_edits, make_edit_log, save_edit_log
+from gazetteer import GAZETTEER, UNRESOLVED
+
+# Spell checker configuration, see get_spell_checker
+SPELL_CHECKER_CONFIG = {
+    'max_dictionary_edit_distance': 2,
+    'prefix_length': 7,
+    'dictionary': 'frequency_dictionary_en_82_765.txt',
+    'bigram_dictionary': 'frequency_bigramdictionary_en_243_342.txt',
+}
+
+# Sheets and columns touched by clean_smac_data
+CLEANED_SHEETS = ['Follow_Up', 'Trigger_NA', 'Trigger_Ave', 'Trigger_Other', 'Follow_Up_Other']
+LOCATION_COLUMNS = ['District', 'Chiefdom', 'Section']
+COUNT_FAILURE_COLUMNS = ['Sheet', 'Column', 'Row', 'Value']
+TEXT_COLUMNS = {
+    'Trigger_Other': ['t_q4', 't_q6', 't_q7', 't_q8', 't_q9', 't_q10', 't_q11'],
+    'Follow_Up_Other': ['f_q2', 'f_q3', 'f_q4', 'f_q5', 'f_q6'],
+}
 
 
 def get_parser():
@@ -36,12 +46,25 @@ def get_parser():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
 
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=0,
+        help='When positive, streams the sheets through the cleaning procedures this many rows '
+             'at a time and writes the cleaned CSVs, instead of loading whole sheets into memory.',
+    )
     parser.add_argument(
         '--clean_data',
         type=parse_bool,
         default=True,
         help='Applies automated cleaning procedures to the SMAC data.',
     )
+    parser.add_argument(
+        '--compact',
+        type=parse_bool,
+        default=True,
+        help='Loads columns with the compact dtypes declared in schemas.py.',
+    )
     parser.add_argument(
         '--data_kind',
         type=lambda x: x.lower(),
@@ -50,18 +73,50 @@ def get_parser():
         help='Determines the data flavor that is loaded. '
              'clean has been manually curated and raw is unchanged.',
     )
+    parser.add_argument(
+        '--incremental',
+        type=parse_bool,
+        default=False,
+        help='Only recleans, revalidates and resaves the sheets whose inputs changed since the '
+             'last incremental run, see build_smac_data.',
+    )
+    parser.add_argument(
+        '--location_ids',
+        type=parse_bool,
+        default=False,
+        help='Adds district_id, chiefdom_id and section_id columns to the cleaned sheets.',
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Number of worker processes the sheets are cleaned on, 1 cleans them in this process.',
+    )
     parser.add_argument(
         '--save_csvs',
         type=parse_bool,
         default=False,
         help='Saves data CSVs before automated cleaning has been applied.',
     )
+    parser.add_argument(
+        '--save_edit_log',
+        type=parse_bool,
+        default=False,
+        help='Logs every value changed by the automated cleaning procedures to data/edit_logs, '
+             'see edit_log.py.',
+    )
     parser.add_argument(
         '--save_clean_csvs',
         type=parse_bool,
         default=False,
         help='Saves data CSVs after automated cleaning has been applied.',
     )
+    parser.add_argument(
+        '--use_cache',
+        type=parse_bool,
+        default=True,
+        help='Loads sheets from the columnar cache in data/cache when their CSVs are unchanged.',
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -74,43 +129,357 @@ def get_parser():
 
 
 def main(
+        chunksize=0,
         clean_data=True,
+        compact=True,
         data_kind='clean',
+        incremental=False,
+        location_ids=False,
+        processes=1,
         save_clean_csvs=False,
         save_csvs=False,
+        save_edit_log=False,
+        use_cache=True,
         verbose=False,
 ):
-    dfs = load_smac_data(data_kind=data_kind)
+    if incremental:
+        if chunksize > 0:
+            raise ValueError('The incremental build keeps whole cleaned sheets, it cannot be combined with chunksize!')
+        build_smac_data(
+            data_kind=data_kind,
+            compact=compact,
+            location_ids=location_ids,
+            processes=processes,
+            save_clean_csvs=save_clean_csvs,
+            save_edit_log=save_edit_log,
+            verbose=verbose,
+        )
+        return
+
+    if chunksize > 0:
+        stream_clean_smac_data(
+            data_kind=data_kind,
+            chunksize=chunksize,
+            compact=compact,
+            location_ids=location_ids,
+            verbose=verbose,
+        )
+        return
+
+    dfs = load_smac_data(data_kind=data_kind, compact=compact, use_cache=use_cache, verbose=verbose)
 
     if save_csvs:
         for sheet, df in sorted(dfs.items()):
             df.to_csv(f'../data/{data_kind}/all_paper_data_{sheet.strip().replace(" ", "_")}.csv', index=False)
 
     if clean_data:
-        dfs = clean_smac_data(dfs, verbose=verbose)
+        failures = []
+        edits = [] if save_edit_log else None
+        dfs = clean_smac_data(
+            dfs,
+            location_ids=location_ids,
+            processes=processes,
+            failures=failures,
+            edits=edits,
+            verbose=verbose,
+        )
+        save_count_failures(failures, data_kind=data_kind, verbose=verbose)
+        if save_edit_log:
+            save_smac_edit_log(edits, data_kind=data_kind, verbose=verbose)
 
-    for sheet_name in dfs.keys():
-        if sheet_name in {'Codebook', 'digital'}:
-            continue
-        validate_sheet_locations(dfs, sheet_name=sheet_name, data_kind=data_kind, verbose=verbose)
+    validate_locations(dfs, data_kind=data_kind, verbose=verbose)
 
     if verbose:
         print('Summary of cleaned sheets:')
         for label, df in sorted(dfs.items()):
             print(f'{label}:\n{df.dtypes}\n\n')
 
+        print('Memory usage (MB):')
+        for label, size in sorted(schemas.memory_usage(dfs).items()):
+            print(f'\t{label}: {size:.2f}')
+
     if save_clean_csvs:
         for sheet, df in sorted(dfs.items()):
             df.to_csv(f'../data/{data_kind}/all_paper_data_{sheet.strip().replace(" ", "_")}_clean.csv', index=False)
 
 
-def load_smac_data(data_kind='clean'):
+def build_smac_data(
+        data_kind='clean',
+        compact=True,
+        location_ids=False,
+        processes=1,
+        save_clean_csvs=False,
+        save_edit_log=False,
+        cache_path='../data/cache',
+        map_path='../data/column_maps',
+        report_path='../data/column_discrepancies',
+        edit_log_path='../data/edit_logs',
+        verbose=False,
+):
+    """
+    Incremental equivalent of main with clean_data set. The work is split into stages
+    whose inputs are recorded in cache_path/build/{data_kind}.json:
+        - clean/{sheet}: the sheet CSV, the Codebook, its column map JSONs and the
+          cleaning code.
+          The cleaned sheet, its count failures and, with save_edit_log, its edit log
+          are kept in the columnar cache along with their digests. The stale sheets
+          are cleaned on processes workers, like clean_smac_data does.
+        - count_failures: the digests of the count failures of every sheet.
+        - edit_log: the digests of the edit logs of every sheet, only when
+          save_edit_log is set.
+        - validate: the digests of the cleaned sheets and the cleaning code.
+        - save/{sheet}: the digest of the cleaned sheet (the CSV for sheets that are
+          not cleaned), only when save_clean_csvs is set.
+    A stage only runs when one of its inputs or outputs changed, and sheets are only
+    read when a stage that needs them runs.
+
+    Returns:
+        A dictionary of stage -> 'ran' or 'skipped'.
+    """
+    state = cache.BuildState(Path(cache_path) / 'build' / f'{data_kind}.json')
+    source_path = Path(__file__).resolve().parent
+    code_files = [source_path / name for name in ['etl.py', 'schemas.py', 'gazetteer.py', 'sierra_leone.py']]
+    params = {'compact': compact, 'location_ids': location_ids}
+
+    paths = sheet_paths(data_kind)
+    dfs = load_smac_data(data_kind=data_kind, compact=compact, cache_path=cache_path, verbose=verbose)
+    status = dict()
+
+    def cleaned_path(sheet, kind='cleaned'):
+        return Path(cache_path) / data_kind / kind / sheet
+
+    stale = dict()
+    for sheet in CLEANED_SHEETS:
+        stage = f'clean/{sheet}'
+        map_files = [Path(map_path) / f'{sheet}_{col}_map.json' for col in TEXT_COLUMNS.get(sheet, [])]
+        map_files += [Path(map_path) / f'{loc_col.lower()}_map.json' for loc_col in LOCATION_COLUMNS]
+        files = [paths[sheet], Path(schemas.CODEBOOK_PATH)] + map_files + code_files
+        outputs = [cleaned_path(sheet, kind) / 'manifest.json' for kind in ['cleaned', 'count_failures']]
+        # Edit logs are only kept when asked for, a sheet without one is cleaned again.
+        has_edit_log = (
+            'edit_log_digest' in state.stages.get(stage, dict())
+            and (cleaned_path(sheet, 'edit_log') / 'manifest.json').is_file()
+        )
+        if state.is_fresh(stage, files, params, outputs) and (has_edit_log or not save_edit_log):
+            status[stage] = 'skipped'
+        else:
+            stale[sheet] = (files, outputs)
+
+    if stale:
+        maps = load_column_maps(path=map_path, verbose=verbose)
+        if not all(name in maps for name in column_map_names()):
+            prepare_column_maps(dfs, path=map_path, verbose=verbose)
+            maps = load_column_maps(path=map_path, verbose=verbose)
+
+        tasks = sorted(
+            ((sheet, dfs[sheet], location_ids, save_edit_log) for sheet in stale),
+            key=lambda task: -len(task[1]),
+        )
+        if processes == 1:
+            init_cleaning_worker(maps)
+            results = [clean_smac_sheet_task(task) for task in tasks]
+        else:
+            with Pool(processes=processes, initializer=init_cleaning_worker, initargs=(maps, )) as pool:
+                results = list(pool.imap_unordered(clean_smac_sheet_task, tasks))
+
+        for sheet, df, failures, edits, seconds in results:
+            stage = f'clean/{sheet}'
+            files, outputs = stale[sheet]
+            digests = {'digest': cache.frame_digest(df), 'failures_digest': cache.frame_digest(failures)}
+            cache.save_frame(df, cleaned_path(sheet), {'stage': stage})
+            cache.save_frame(failures, cleaned_path(sheet, 'count_failures'), {'stage': stage})
+            if save_edit_log:
+                log = make_edit_log(edits)
+                digests['edit_log_digest'] = cache.frame_digest(log)
+                cache.save_frame(log, cleaned_path(sheet, 'edit_log'), {'stage': stage})
+            elif cleaned_path(sheet, 'edit_log').exists():
+                # The edit log of an earlier run no longer matches the cleaned sheet.
+                shutil.rmtree(cleaned_path(sheet, 'edit_log'))
+            state.record(stage, files, params, outputs, **digests)
+            status[stage] = 'ran'
+            if verbose:
+                print(f'Cleaned {sheet} in {seconds:.3f}s')
+
+    stages = {sheet: state.stages[f'clean/{sheet}'] for sheet in CLEANED_SHEETS}
+    digests = {sheet: stage['digest'] for sheet, stage in stages.items()}
+
+    failure_digests = {sheet: stage['failures_digest'] for sheet, stage in stages.items()}
+    outputs = [Path(report_path) / f'{data_kind}_count_failures.csv']
+    if state.is_fresh('count_failures', values=failure_digests, outputs=outputs):
+        status['count_failures'] = 'skipped'
+    else:
+        failures = [cache.load_frame(cleaned_path(sheet, 'count_failures')) for sheet in CLEANED_SHEETS]
+        save_count_failures(failures, data_kind=data_kind, output_path=report_path, verbose=verbose)
+        state.record('count_failures', values=failure_digests, outputs=outputs)
+        status['count_failures'] = 'ran'
+
+    if save_edit_log:
+        edit_log_digests = {sheet: stage['edit_log_digest'] for sheet, stage in stages.items()}
+        outputs = [Path(edit_log_path) / data_kind / 'manifest.json']
+        if state.is_fresh('edit_log', values=edit_log_digests, outputs=outputs):
+            status['edit_log'] = 'skipped'
+        else:
+            edits = [cache.load_frame(cleaned_path(sheet, 'edit_log')) for sheet in CLEANED_SHEETS]
+            save_smac_edit_log(edits, data_kind=data_kind, output_path=edit_log_path, verbose=verbose)
+            state.record('edit_log', values=edit_log_digests, outputs=outputs)
+            status['edit_log'] = 'ran'
+
+    outputs = [Path(report_path) / f'{data_kind}_location_report.json']
+    if state.is_fresh('validate', code_files, digests, outputs):
+        status['validate'] = 'skipped'
+    else:
+        locations = {
+            sheet: cache.load_frame(cleaned_path(sheet), usecols=LOCATION_COLUMNS)
+            for sheet in CLEANED_SHEETS
+        }
+        validate_locations(locations, data_kind=data_kind, output_path=report_path, verbose=verbose)
+        state.record('validate', code_files, digests, outputs)
+        status['validate'] = 'ran'
+
+    if save_clean_csvs:
+        for sheet, path in sorted(paths.items()):
+            stage = f'save/{sheet}'
+            output_file = path.parent / f'all_paper_data_{sheet.strip().replace(" ", "_")}_clean.csv'
+            files = [] if sheet in CLEANED_SHEETS else [path]
+            values = {'digest': digests.get(sheet), 'compact': compact}
+            if state.is_fresh(stage, files, values, [output_file]):
+                status[stage] = 'skipped'
+                continue
+
+            df = cache.load_frame(cleaned_path(sheet)) if sheet in CLEANED_SHEETS else dfs[sheet]
+            df.to_csv(output_file, index=False)
+            state.record(stage, files, values, [output_file])
+            status[stage] = 'ran'
+
+    state.save()
+
+    if verbose:
+        for stage, result in status.items():
+            print(f'{stage}: {result}')
+
+    return status
+
+
+def load_smac_data(
+        data_kind='clean',
+        compact=True,
+        usecols=None,
+        use_cache=True,
+        cache_path='../data/cache',
+        data_path='../data',
+        verbose=False,
+):
+    """
+    Provides every sheet CSV for a data kind as a dictionary-like mapping of DataFrames.
+
+    Sheets are read lazily, the first time they are accessed, so callers that only need
+    one sheet only pay for that sheet. Parsed sheets are persisted to a columnar cache
+    under cache_path and reused for as long as the source CSV is unchanged.
+
+    Args:
+        data_kind: Either 'clean' or 'raw', the subdirectory of data to load.
+        compact: Convert columns to the compact dtypes declared in schemas.
+        usecols: Optional list of columns to load, sheets without some of these
+            columns simply load the ones they have.
+        use_cache: Read from and write to the on-disk cache.
+        cache_path: Root directory of the cache.
+        data_path: Directory holding the clean and raw subdirectories.
+        verbose: Report per-sheet load times and whether the cache was hit.
+    """
+    return LazySheetDict(
+        data_kind=data_kind,
+        compact=compact,
+        usecols=usecols,
+        use_cache=use_cache,
+        cache_path=cache_path,
+        data_path=data_path,
+        verbose=verbose,
+    )
+
+
+def load_sheet(
+        path,
+        compact=True,
+        usecols=None,
+        use_cache=True,
+        cache_path='../data/cache',
+):
+    """
+    Loads a single sheet CSV, through the columnar cache when use_cache is set.
+
+    Returns:
+        A tuple of the DataFrame and a flag indicating whether the cache was hit.
+    """
+    path = Path(path)
+    if not use_cache:
+        return read_sheet_csv(path, compact=compact, usecols=usecols), False
+
+    flavor = f'compact_v{schemas.SCHEMA_VERSION}' if compact else 'inferred'
+    sheet_cache_path = Path(cache_path) / path.parent.name / flavor / sheet_name_from_path(path)
+    return load_cached_sheet(path, sheet_cache_path, compact=compact, usecols=usecols)
+
+
+def sheet_paths(data_kind='clean', data_path='../data'):
+    """
+    Returns the CSV of each sheet keyed by sheet name. Cleaned outputs written next to
+    the sheets by main or stream_clean_smac_data (*_clean.csv) are not sheets.
+    """
     return {
-        path.stem.replace('all_paper_data_', ''): pd.read_csv(path, parse_dates=[0])
-        for path in sorted(Path(f'../data/{data_kind}').glob('*.csv'))
+        sheet_name_from_path(path): path
+        for path in sorted((Path(data_path) / data_kind).glob('*.csv'))
+        if not path.stem.endswith('_clean')
     }
 
 
+def sheet_name_from_path(path):
+    return Path(path).stem.replace('all_paper_data_', '')
+
+
+def read_sheet_csv(path, compact=True, usecols=None):
+    path = Path(path)
+    if usecols is None:
+        df = pd.read_csv(path, parse_dates=[0])
+    else:
+        # parse_dates=[0] refers to the first column of the file, which may not be
+        # selected, so resolve it by name instead.
+        header = list(pd.read_csv(path, nrows=0).columns)
+        usecols = [col for col in header if col in set(usecols)]
+        df = pd.read_csv(path, usecols=usecols, parse_dates=[col for col in header[:1] if col in usecols])
+
+    if compact:
+        df = schemas.apply_schema(df, sheet_name=sheet_name_from_path(path))
+    return df
+
+
+def load_cached_sheet(csv_path, sheet_cache_path, compact=True, usecols=None):
+    """
+    Loads a sheet from the columnar cache, (re)building the cache entry from the CSV
+    when it is missing or the CSV has changed since it was written. Compact entries
+    are also rebuilt when the Codebook or gazetteer changed, see schemas.schema_digest.
+
+    Returns:
+        A tuple of the DataFrame and a flag indicating whether the cache was hit.
+    """
+    schema = schemas.schema_digest() if compact else None
+    manifest = cache.load_manifest(sheet_cache_path)
+    if manifest is not None and manifest.get('schema') == schema:
+        matches, refreshed = cache.signature_matches(csv_path, manifest['source'])
+        if matches:
+            if refreshed:
+                cache.update_manifest(sheet_cache_path, source=cache.file_signature(csv_path))
+            if usecols is not None:
+                usecols = [col for col in manifest['columns'] if col in set(usecols)]
+            return cache.load_frame(sheet_cache_path, usecols=usecols, manifest=manifest), True
+
+    # The whole sheet is cached even when only some columns were requested so that
+    # later calls asking for other columns still hit the cache.
+    df = read_sheet_csv(csv_path, compact=compact)
+    cache.save_frame(df, sheet_cache_path, {'source': cache.file_signature(csv_path), 'schema': schema})
+    if usecols is not None:
+        df = df[[col for col in df.columns if col in set(usecols)]]
+    return df, False
+
+
 def load_smac_data_old(path='../data/clean/all_paper_data.xlsx'):
     dfs = pd.read_excel(
         path,
@@ -131,110 +500,717 @@ def load_smac_data_old(path='../data/clean/all_paper_data.xlsx'):
     return dfs
 
 
-def clean_smac_data(dfs, verbose=False):
-    # Parse an additional date column
-    dfs['Follow_Up'].Date_of_dep = pd.to_datetime(dfs['Follow_Up'].Date_of_dep)
-
-    clean_int_col_map = IDDict({'o': 0, 'O': 0, 'nan': 0})
-    for i in range(100):
-        clean_int_col_map[i] = i
+def clean_smac_data(
+        dfs,
+        location_ids=False,
+        processes=1,
+        failures=None,
+        edits=None,
+        map_path='../data/column_maps',
+        bundle_path='../data/cache/column_maps.pkl',
+        verbose=False,
+):
+    """
+    Args:
+        dfs: Dictionary of sheet name -> DataFrame, as returned by load_smac_data.
+        location_ids: Also add the district_id, chiefdom_id and section_id columns,
+            see add_location_ids.
+        processes: Number of worker processes. The sheets are cleaned independently,
+            so with more than one process each sheet is a task on a worker pool,
+            largest first. The result is identical to cleaning them in this process.
+        failures: Optional list, the count values of each sheet that could not be
+            coerced are appended to it, see coerce_counts.
+        edits: Optional list, the values each sheet had changed are appended to it as
+            edit log entries, see edit_log.py and make_edit_log.
+        map_path: Directory of the column map JSONs, missing maps are written to it.
+        bundle_path: Compiled bundle of the column maps, see load_column_maps.
+        verbose: Report on the column maps and the time spent on each sheet.
 
-    dfs['Follow_Up'].Children = dfs['Follow_Up'].Children.map(clean_int_col_map)
-    dfs['Follow_Up'].r_mc = dfs['Follow_Up'].r_mc.map(clean_int_col_map)
-    dfs['Follow_Up'].r_fa = dfs['Follow_Up'].r_fa.map(clean_int_col_map)
+    Returns:
+        dfs, with the cleaned sheets replaced.
+    """
+    maps = load_column_maps(path=map_path, bundle_path=bundle_path, verbose=verbose)
+    if not all(name in maps for name in column_map_names()):
+        prepare_column_maps(dfs, path=map_path, verbose=verbose)
+        maps = load_column_maps(path=map_path, bundle_path=bundle_path, verbose=verbose)
 
-    # Fill in the Children column when it is NA and Male_child + Female_child are not NA
-    index = (
-            dfs['Trigger_Ave'].Children.isna() &
-            ~dfs['Trigger_Ave'].Male_child.isna() &
-            ~dfs['Trigger_Ave'].Female_child.isna()
-    )
-    dfs['Trigger_Ave'].Children.loc[index] = (
-            dfs['Trigger_Ave'].Male_child.loc[index] +
-            dfs['Trigger_Ave'].Female_child.loc[index]
+    tasks = sorted(
+        ((sheet, dfs[sheet], location_ids, edits is not None) for sheet in CLEANED_SHEETS),
+        key=lambda task: -len(task[1]),
     )
+    if processes == 1:
+        init_cleaning_worker(maps)
+        results = [clean_smac_sheet_task(task) for task in tasks]
+    else:
+        with Pool(processes=processes, initializer=init_cleaning_worker, initargs=(maps, )) as pool:
+            results = list(pool.imap_unordered(clean_smac_sheet_task, tasks))
 
-    # Map the time since last ebola case question from a string to an approximate Timedelta
-    t_q1_map = IDDict({
-        'last week': pd.Timedelta(days=7),
-        '2-3 weeks': pd.Timedelta(days=17, hours=6),
-        '3weeks': pd.Timedelta(days=21),
-        '4 weeks or more': pd.Timedelta(days=28),
-        '4 weeks 0r m0re': pd.Timedelta(days=28),
-        '5 weeks or more': pd.Timedelta(days=35),
-    })
-    dfs['Trigger_Other'].t_q1 = dfs['Trigger_Other'].t_q1.str.strip().str.lower().map(t_q1_map)
-
-    # Map the t_q5 column from a string response to a categorical variable
-    t_q5_map = IDDict({
-        'very low': 0,
-        'low': 1,
-        'medium': 2,
-        'high': 3,
-        'very high': 4,
-        'very hig': 4,
-    })
-    dfs['Trigger_Other'].t_q5 = dfs['Trigger_Other'].t_q5.str.strip().str.lower().map(t_q5_map)
+    for sheet, df, sheet_failures, sheet_edits, seconds in results:
+        dfs[sheet] = df
+        if failures is not None:
+            failures.append(sheet_failures)
+        if edits is not None:
+            edits.extend(sheet_edits)
+        if verbose:
+            print(f'Cleaned {sheet} in {seconds:.3f}s')
 
-    # Clean up the text based columns
-    sheets = ['Trigger_Other', 'Follow_Up_Other']
-    str_colz = [
-        ['t_q4', 't_q6', 't_q7', 't_q8', 't_q9', 't_q10', 't_q11'],
-        ['f_q2', 'f_q3', 'f_q4', 'f_q5', 'f_q6'],
+    return dfs
+
+
+# Column maps of the current process, set by init_cleaning_worker.
+_cleaning_maps = dict()
+
+
+def init_cleaning_worker(maps):
+    _cleaning_maps.clear()
+    _cleaning_maps.update(maps)
+
+
+def clean_smac_sheet_task(task):
+    """
+    Cleans one sheet with the maps given to init_cleaning_worker.
+
+    Args:
+        task: Tuple of (sheet, df, location_ids, log_edits).
+
+    Returns:
+        A tuple of (sheet, cleaned df, count failures, edit log entries or None,
+        seconds spent).
+    """
+    sheet, df, location_ids, log = task
+    start = time.perf_counter()
+    failures = []
+    edits = [] if log else None
+    df = clean_smac_sheet(sheet, df, _cleaning_maps, failures=failures, edits=edits)
+    if location_ids:
+        df = add_location_ids(df)
+    return sheet, df, failures[0], edits, time.perf_counter() - start
+
+
+def prepare_column_maps(
+        dfs,
+        path='../data/column_maps',
+        spelling_processes=None,
+        spelling_chunksize=64,
+        verbose=False,
+):
+    """
+    Constructs any of the text and location column maps that do not exist yet. The
+    maps are built from all of the values in a column, so this must see whole sheets
+    (or at least every unique value) before any cleaning is applied.
+    """
+    missing = [
+        (sheet, str_col)
+        for sheet, str_cols in TEXT_COLUMNS.items()
+        for str_col in str_cols
+        if not Path(f'{path}/{sheet}_{str_col}_map.json').is_file()
     ]
+    if missing:
+        if verbose:
+            print(f'Constructing spelling correction maps: {", ".join(f"{x} - {y}" for x, y in missing)}')
 
-    for sheet, str_cols in zip(sheets, str_colz):
-        for str_col in str_cols:
-            map_file = f'../data/column_maps/{sheet}_{str_col}_map.json'
-            if not Path(map_file).is_file():
-                make_spelling_correction_map(dfs, sheet=sheet, col=str_col)
-
-            with open(map_file) as f:
-                str_col_map = IDDict(json.load(f))
-            dfs[sheet].loc[:, str_col] = (
-                dfs[sheet].loc[:, str_col]
-                    .str.lower()
-                    .str.strip(' .,\"')
-                    .str.replace('  ', ' ')
-                    .map(str_col_map)
+        with get_spelling_cache() as spelling_cache:
+            make_spelling_correction_maps(
+                dfs,
+                columns=missing,
+                spelling_cache=spelling_cache,
+                processes=spelling_processes,
+                chunksize=spelling_chunksize,
+                output_path=path,
+                verbose=verbose,
             )
 
-    # Clean up the location columns
-    sheets = ['Follow_Up', 'Trigger_NA', 'Trigger_Ave', 'Trigger_Other', 'Follow_Up_Other']
-    loc_cols = ['District', 'Chiefdom', 'Section']
+            if verbose:
+                stats = spelling_cache.stats
+                print(
+                    f'Spelling cache hit rate: {100. * spelling_cache.hit_rate():.1f}% '
+                    f'({stats["hits"]} hits, {stats["misses"]} misses), '
+                    f'saved ~{stats["seconds_saved"]:.1f}s of spell checking '
+                    f'(spent {stats["seconds_spent"]:.1f}s)'
+                )
 
-    if not check_location_maps():
+    if not check_location_maps(path):
         print('Constructing default location mappings.')
-        make_location_maps(dfs)
+        make_location_maps(dfs, output_path=path)
 
-    for loc_col in loc_cols:
-        map_file = f'../data/column_maps/{loc_col.lower()}_map.json'
-        if verbose:
-            print(f'Loading map file: {map_file}')
+
+def load_column_maps(path='../data/column_maps', bundle_path='../data/cache/column_maps.pkl', verbose=False):
+    """
+    Loads the text and location column maps used by clean_smac_sheet.
+
+    All of the *_map.json files are compiled into a single pickled bundle, recording
+    a signature of every source JSON. As long as the set of JSON files and their
+    signatures are unchanged the bundle is loaded with one read, otherwise it is
+    recompiled first.
+
+    Returns:
+        A dictionary of IDDicts keyed by the map file name without the _map.json
+        suffix, e.g. 'chiefdom' or 'Trigger_Other_t_q4'. Maps that do not exist yet
+        are absent, see prepare_column_maps.
+    """
+    bundle_path = Path(bundle_path)
+    map_files = {map_file.name[:-len('_map.json')]: map_file for map_file in Path(path).glob('*_map.json')}
+
+    bundle = None
+    if bundle_path.is_file():
+        try:
+            with open(bundle_path, 'rb') as f:
+                bundle = pickle.load(f)
+        except (AttributeError, pickle.UnpicklingError):
+            # e.g. a bundle written by an older version that pickled the IDDict class.
+            bundle = None
+
+    if bundle is not None:
+        if bundle.get('version') == cache.CACHE_VERSION and bundle['sources'].keys() == map_files.keys():
+            checks = {
+                name: cache.signature_matches(map_file, bundle['sources'][name])
+                for name, map_file in map_files.items()
+            }
+            if all(matches for matches, _ in checks.values()):
+                if any(refreshed for _, refreshed in checks.values()):
+                    for name, (_, refreshed) in checks.items():
+                        if refreshed:
+                            bundle['sources'][name] = cache.file_signature(map_files[name])
+                    save_column_map_bundle(bundle, bundle_path)
+                if verbose:
+                    print(f'Loaded {len(bundle["maps"])} column maps from {bundle_path}')
+                return {name: IDDict(mapping) for name, mapping in bundle['maps'].items()}
+
+    bundle = compile_column_maps(map_files, bundle_path)
+    if verbose:
+        print(f'Compiled {len(bundle["maps"])} column maps into {bundle_path}')
+    return {name: IDDict(mapping) for name, mapping in bundle['maps'].items()}
+
+
+def compile_column_maps(map_files, bundle_path='../data/cache/column_maps.pkl'):
+    """
+    Merges map JSON files into a single bundle and saves it.
+
+    Args:
+        map_files: Dictionary of map name -> path of the JSON file.
+        bundle_path: Where the bundle is saved.
+    """
+    bundle = {
+        'version': cache.CACHE_VERSION,
+        'sources': dict(),
+        'maps': dict(),
+    }
+    for name, map_file in sorted(map_files.items()):
+        bundle['sources'][name] = cache.file_signature(map_file)
         with open(map_file) as f:
-            loc_col_map = IDDict(json.load(f))
-        for sheet in sheets:
-            dfs[sheet].loc[:, loc_col] = dfs[sheet].loc[:, loc_col].str.strip().map(loc_col_map)
+            # Plain dicts, IDDict is pickled by reference to the module that defined it,
+            # which is __main__ when etl.py is run as a script.
+            bundle['maps'][name] = json.load(f)
 
-    return dfs
+    save_column_map_bundle(bundle, bundle_path)
+    return bundle
+
+
+def save_column_map_bundle(bundle, bundle_path):
+    bundle_path = Path(bundle_path)
+    bundle_path.parent.mkdir(exist_ok=True, parents=True)
+
+    # Write to a temporary file first so that readers never see a partial bundle.
+    tmp_path = bundle_path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(bundle_path)
+
+
+def clean_smac_sheet(sheet, df, maps, dtypes=None, failures=None, edits=None):
+    """
+    Applies the automated cleaning procedures to a single sheet. Every step only looks
+    at the row being cleaned, so a sheet can equally be cleaned whole or in chunks.
+
+    Args:
+        sheet: Name of the sheet, determines which steps apply.
+        df: The sheet, modified in place.
+        maps: Column maps as returned by load_column_maps.
+        dtypes: Optional dictionary of output dtypes for the mapped columns. By default
+            pandas infers them from the mapped values, which depends on which values a
+            chunk happens to contain, so streamed cleaning pins them to the dtypes of
+            the whole sheet.
+        failures: Optional list, a DataFrame of the count values that could not be
+            coerced is appended to it, see coerce_counts.
+        edits: Optional list, the values changed by each step are appended to it as
+            edit log entries. The rule of an entry is the name of the column map or
+            of the step.
+
+    Returns:
+        The cleaned sheet.
+    """
+    dtypes = dtypes or dict()
+
+    if sheet == 'Follow_Up':
+        # Parse an additional date column
+        original = df.Date_of_dep
+        df['Date_of_dep'] = pd.to_datetime(df.Date_of_dep)
+        log_edits(edits, sheet, 'Date_of_dep', original, df.Date_of_dep, rule='parse_date')
+
+    # Coerce the count columns, some have typos such as 'o' instead of 0
+    df, sheet_failures = coerce_counts(sheet, df, edits=edits)
+    if failures is not None:
+        failures.append(sheet_failures)
+
+    if sheet == 'Trigger_Ave':
+        # Fill in the Children column when it is NA and Male_child + Female_child are not NA
+        original = df.Children.copy()
+        index = df.Children.isna() & ~df.Male_child.isna() & ~df.Female_child.isna()
+        df.loc[index, 'Children'] = df.Male_child.loc[index] + df.Female_child.loc[index]
+        log_edits(edits, sheet, 'Children', original, df.Children, rule='fill_children')
+
+    if sheet == 'Trigger_Other':
+        # Map the time since last ebola case question from a string to an approximate Timedelta
+        t_q1_map = IDDict({
+            'last week': pd.Timedelta(days=7),
+            '2-3 weeks': pd.Timedelta(days=17, hours=6),
+            '3weeks': pd.Timedelta(days=21),
+            '4 weeks or more': pd.Timedelta(days=28),
+            '4 weeks 0r m0re': pd.Timedelta(days=28),
+            '5 weeks or more': pd.Timedelta(days=35),
+        })
+        original = df.t_q1
+        df['t_q1'] = apply_column_map(df.t_q1.str.strip().str.lower(), t_q1_map, dtype=dtypes.get('t_q1'))
+        log_edits(edits, sheet, 't_q1', original, df.t_q1, rule='t_q1_map')
+
+        # Map the t_q5 column from a string response to a categorical variable
+        t_q5_map = IDDict({
+            'very low': 0,
+            'low': 1,
+            'medium': 2,
+            'high': 3,
+            'very high': 4,
+            'very hig': 4,
+        })
+        original = df.t_q5
+        df['t_q5'] = apply_column_map(df.t_q5.str.strip().str.lower(), t_q5_map, dtype=dtypes.get('t_q5'))
+        log_edits(edits, sheet, 't_q5', original, df.t_q5, rule='t_q5_map')
+
+    # Clean up the text based columns
+    for str_col in TEXT_COLUMNS.get(sheet, []):
+        original = df[str_col]
+        df[str_col] = apply_column_map(
+            df[str_col]
+                .str.lower()
+                .str.strip(' .,\"')
+                .str.replace('  ', ' '),
+            maps[f'{sheet}_{str_col}'],
+            dtype=dtypes.get(str_col),
+        )
+        log_edits(edits, sheet, str_col, original, df[str_col], rule=f'{sheet}_{str_col}')
+
+    # Clean up the location columns
+    if sheet in CLEANED_SHEETS:
+        for loc_col in LOCATION_COLUMNS:
+            original = df[loc_col]
+            df[loc_col] = apply_column_map(
+                df[loc_col].str.strip(),
+                maps[loc_col.lower()],
+                dtype=dtypes.get(loc_col),
+            )
+            log_edits(edits, sheet, loc_col, original, df[loc_col], rule=loc_col.lower())
+
+    return df
+
+
+def coerce_counts(sheet, df, edits=None):
+    """
+    Converts every count and total column of a sheet to nullable integers with
+    schemas.to_count, which works on the distinct values of a column rather than on
+    every row.
+
+    Args:
+        sheet: Name of the sheet, used in the report.
+        df: The sheet, modified in place.
+        edits: Optional list, changed values are logged to it with the rule coerce_count.
+
+    Returns:
+        A tuple of the sheet and a DataFrame with the Sheet, Column, Row (index label)
+        and Value of every value that could not be coerced and was set to NA.
+    """
+    failures = [pd.DataFrame(columns=COUNT_FAILURE_COLUMNS)]
+    for col, kind in schemas.get_schema(df.columns).items():
+        if kind not in {'count', 'total'}:
+            continue
+
+        original = df[col]
+        df[col], failed = schemas.to_count(original, dtype=schemas.KIND2DTYPE[kind])
+        log_edits(edits, sheet, col, original, df[col], rule='coerce_count')
+        if failed.any():
+            failures.append(pd.DataFrame({
+                'Sheet': sheet,
+                'Column': col,
+                'Row': original.index[failed],
+                'Value': original[failed].astype(str).to_numpy(),
+            }))
+
+    return df, pd.concat(failures, ignore_index=True)
+
+
+def save_count_failures(failures, data_kind, output_path='../data/column_discrepancies', verbose=False):
+    """
+    Writes the count values that could not be coerced to {data_kind}_count_failures.csv.
+
+    Args:
+        failures: List of DataFrames collected by clean_smac_sheet.
+        data_kind: Either 'clean' or 'raw', prefixes the file name.
+        output_path: Directory the report is written to.
+        verbose: Print the number of failures.
+    """
+    output_path = Path(output_path)
+    output_path.mkdir(exist_ok=True, parents=True)
+
+    report = pd.concat([pd.DataFrame(columns=COUNT_FAILURE_COLUMNS)] + list(failures), ignore_index=True)
+    report.to_csv(output_path / f'{data_kind}_count_failures.csv', index=False)
+    if verbose:
+        print(f'{len(report)} count values could not be coerced, see {data_kind}_count_failures.csv')
+
+
+def save_smac_edit_log(edits, data_kind, output_path='../data/edit_logs', verbose=False):
+    """
+    Writes the edit log collected by clean_smac_data to output_path/{data_kind}, it can
+    be read back with edit_log.load_edit_log.
+    """
+    log = make_edit_log(edits)
+    save_edit_log(log, Path(output_path) / data_kind, data_kind=data_kind)
+    if verbose:
+        print(f'{len(log)} values were changed by the cleaning procedures, see {output_path}/{data_kind}')
+
+
+def apply_column_map(series, mapping, dtype=None):
+    """
+    Maps the values of a series through a dictionary, see IDDict.
+
+    The mapping is only evaluated once per distinct value: the series is factorized,
+    the (small) array of uniques is mapped and the result is taken back to the rows.
+    The cost is therefore proportional to the number of distinct values rather than
+    the number of rows, and the result is the same as Series.map, including the dtype
+    pandas infers since that only depends on which kinds of values are present.
+
+    Args:
+        series: The values to map.
+        mapping: The dictionary, typically an IDDict.
+        dtype: When None the result dtype is inferred from the mapped values, just like
+            Series.map. Otherwise the mapped values are kept as Python objects and only
+            converted if dtype is not object, so e.g. mapped ints in an object column
+            are not turned into floats by an inference over a subset of the rows.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype) and dtype is None:
+        # Categoricals already map their categories rather than their rows.
+        return series.map(mapping)
+
+    codes, uniques = pd.factorize(series)
+    uniques = pd.Series(uniques, dtype=object)
+    if (codes == -1).any():
+        # Missing values are mapped like any other value, they go at the end of uniques.
+        uniques = pd.concat([uniques, pd.Series([np.nan], dtype=object)], ignore_index=True)
+        codes = np.where(codes == -1, len(uniques) - 1, codes)
+
+    if dtype is None:
+        mapped = uniques.map(mapping)
+    else:
+        mapped = pd.Series([mapping[x] for x in uniques], dtype=object)
+        if dtype != 'object':
+            mapped = mapped.infer_objects().astype(dtype)
+
+    return pd.Series(mapped.take(codes).array, index=series.index, name=series.name)
+
+
+def add_location_ids(df):
+    """
+    Adds integer columns with the gazetteer IDs of the (cleaned) location columns, so
+    that aggregations by location and merges between sheets work on small integers
+    rather than strings. Sections are resolved within their chiefdom since section
+    names are not unique. Names missing from the gazetteer get UNRESOLVED (-1).
+
+    Args:
+        df: A sheet with District, Chiefdom and Section columns, modified in place.
+
+    Returns:
+        The sheet with district_id, chiefdom_id and section_id columns.
+    """
+    chiefdom_ids = GAZETTEER.encode('chiefdom', df.Chiefdom)
+    df['district_id'] = GAZETTEER.encode('district', df.District).astype(np.int16)
+    df['chiefdom_id'] = chiefdom_ids.astype(np.int16)
+    df['section_id'] = GAZETTEER.encode('section', df.Section, parent_ids=chiefdom_ids).astype(np.int16)
+    return df
+
+
+def stream_clean_smac_data(
+        data_kind='clean',
+        chunksize=10000,
+        compact=True,
+        location_ids=False,
+        output_path=None,
+        verbose=False,
+):
+    """
+    Cleans every sheet of a data kind in fixed size chunks and writes the results to
+    all_paper_data_{sheet}_clean.csv incrementally, so peak memory is bounded by the
+    chunk size rather than the size of the export. The output is identical to saving
+    the result of clean_smac_data(load_smac_data(...)) with DataFrame.to_csv.
+
+    Matching the in-memory path requires the dtypes pandas would infer for each whole
+    column, so every sheet is read several times:
+        1. Resolve the dtypes the CSV parser would infer and the compact schema plan.
+        2. (Only if a column map is missing) Collect the unique values the maps need.
+        3. Clean each chunk to resolve the dtypes of the cleaned columns.
+        4. Clean each chunk with those dtypes pinned and append it to the output.
+
+    Args:
+        data_kind: Either 'clean' or 'raw', the subdirectory of data to load.
+        chunksize: Number of rows read, cleaned and written at a time.
+        compact: Convert columns to the compact dtypes declared in schemas.
+        location_ids: Add the integer location columns, see add_location_ids.
+        output_path: Directory for the cleaned CSVs, defaults to data/{data_kind}.
+        verbose: Report progress for each sheet.
+    """
+    paths = sheet_paths(data_kind)
+    output_path = Path(output_path or f'../data/{data_kind}')
+    output_path.mkdir(exist_ok=True, parents=True)
+
+    readers = {
+        sheet: ChunkedSheetReader(path, chunksize=chunksize, compact=compact)
+        for sheet, path in paths.items()
+    }
+
+    maps = load_column_maps()
+    if not all(name in maps for name in column_map_names()):
+        if verbose:
+            print('Collecting unique values for the missing column maps.')
+        prepare_column_maps(
+            {sheet: reader.unique_values(map_columns(sheet)) for sheet, reader in readers.items()},
+            verbose=verbose,
+        )
+        maps = load_column_maps()
+
+    failures = []
+    for sheet, reader in readers.items():
+        start = time.perf_counter()
+        dtypes = None
+        if sheet in CLEANED_SHEETS:
+            for chunk in reader:
+                dtypes = merge_dtypes(dtypes, clean_smac_sheet(sheet, chunk, maps).dtypes)
+
+        output_file = output_path / f'all_paper_data_{sheet.strip().replace(" ", "_")}_clean.csv'
+        n_rows = 0
+        for i, chunk in enumerate(reader):
+            if sheet in CLEANED_SHEETS:
+                chunk = clean_smac_sheet(sheet, chunk, maps, dtypes=dtypes, failures=failures)
+                chunk = chunk.astype({col: dtype for col, dtype in dtypes.items() if chunk[col].dtype != dtype})
+                if location_ids:
+                    chunk = add_location_ids(chunk)
+            chunk.to_csv(output_file, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+            n_rows += len(chunk)
+
+        if verbose:
+            print(f'Streamed {n_rows} rows of {sheet} to {output_file} in {time.perf_counter() - start:.3f}s')
+
+    save_count_failures(failures, data_kind=data_kind, verbose=verbose)
+
+
+class ChunkedSheetReader:
+    """
+    Iterates over a sheet CSV in chunks whose dtypes match what pandas infers when
+    reading the whole file at once (and, optionally, the compact schema plan).
+
+    Column dtypes are resolved with one pass over the file when the reader is created.
+    Afterwards, each iteration re-reads the file with those dtypes forced.
+    """
+    def __init__(self, path, chunksize=10000, compact=True):
+        self.path = Path(path)
+        self.sheet = sheet_name_from_path(path)
+        self.chunksize = chunksize
+        self.compact = compact
+
+        self.columns = list(pd.read_csv(self.path, nrows=0).columns)
+        self.dtypes = None
+        self.plan = None
+        for chunk in pd.read_csv(self.path, parse_dates=self.columns[:1], chunksize=chunksize):
+            # Columns that are entirely missing in a chunk carry no information on dtype.
+            self.dtypes = merge_dtypes(self.dtypes, chunk.dropna(axis=1, how='all').dtypes)
+            if compact:
+                self.plan = schemas.merge_plans(self.plan, schemas.plan_schema(chunk, sheet_name=self.sheet))
+
+        # Columns that are missing everywhere are read as float64, like pandas would.
+        self.dtypes = {col: self.dtypes.get(col, 'float64') for col in self.columns}
+        if self.plan is not None:
+            self.plan = {
+                col: dtype
+                for col, dtype in self.plan.items()
+                if not (dtype in schemas.WIDER_INTS and self.dtypes[col] == 'object')
+            }
+
+    def __iter__(self):
+        parse_dates = [col for col in self.columns[:1] if self.dtypes[col].startswith('datetime64')]
+        read_dtypes = {
+            col: str if dtype == 'object' else dtype
+            for col, dtype in self.dtypes.items()
+            if col not in parse_dates
+        }
+        for chunk in pd.read_csv(self.path, dtype=read_dtypes, parse_dates=parse_dates, chunksize=self.chunksize):
+            if self.compact:
+                chunk = schemas.apply_schema(chunk, sheet_name=self.sheet, plan=self.plan)
+            yield chunk
+
+    def unique_values(self, columns):
+        """
+        Returns a DataFrame holding the unique values of the selected columns, padded
+        with NaN, which is enough to construct the column maps.
+        """
+        columns = [col for col in columns if col in self.columns]
+        uniques = {col: set() for col in columns}
+        read_dtypes = {col: str for col in columns if self.dtypes[col] == 'object'}
+        for chunk in pd.read_csv(self.path, usecols=columns, dtype=read_dtypes, chunksize=self.chunksize):
+            for col in columns:
+                uniques[col].update(chunk[col].dropna().unique())
+
+        return pd.DataFrame({col: pd.Series(sorted(values), dtype=object) for col, values in uniques.items()})
+
+
+def merge_dtypes(dtypes_a, dtypes_b):
+    """
+    Combines the dtypes of two chunks of the same sheet following the rules pandas
+    uses when inferring a whole column: ints widen to floats (nullable ints to the
+    wider of the two), anything else that disagrees becomes object.
+
+    Returns:
+        A dictionary mapping column names to dtype names.
+    """
+    dtypes_b = {col: str(dtype) for col, dtype in dict(dtypes_b).items()}
+    if dtypes_a is None:
+        return dtypes_b
 
+    merged = dict(dtypes_a)
+    for col, dtype_b in dtypes_b.items():
+        dtype_a = merged.get(col, dtype_b)
+        if dtype_a == dtype_b:
+            merged[col] = dtype_a
+        elif {dtype_a, dtype_b} == {'int64', 'float64'}:
+            merged[col] = 'float64'
+        elif dtype_a in schemas.WIDER_INTS and dtype_b in schemas.WIDER_INTS:
+            merged[col] = max(dtype_a, dtype_b, key=schemas.WIDER_INTS.index)
+        elif {dtype_a, dtype_b} & set(schemas.WIDER_INTS) and 'float64' in {dtype_a, dtype_b}:
+            # A count column with fractions in some chunk, see schemas.to_count.
+            merged[col] = 'float64'
+        else:
+            merged[col] = 'object'
+    return merged
+
+
+def column_map_names():
+    return [loc_col.lower() for loc_col in LOCATION_COLUMNS] + [
+        f'{sheet}_{str_col}'
+        for sheet, str_cols in TEXT_COLUMNS.items()
+        for str_col in str_cols
+    ]
 
-def make_spelling_correction_map(dfs, sheet, col):
-    values = sorted(
-        dfs[sheet][col].str.lower().str.strip(' .,\"').str.replace('  ', ' ').dropna().unique()
+
+def map_columns(sheet):
+    return TEXT_COLUMNS.get(sheet, []) + (LOCATION_COLUMNS if sheet in CLEANED_SHEETS else [])
+
+
+def make_spelling_correction_map(
+        dfs,
+        sheet,
+        col,
+        spelling_cache=None,
+        processes=None,
+        output_path='../data/column_maps',
+        verbose=False,
+):
+    make_spelling_correction_maps(
+        dfs,
+        columns=[(sheet, col)],
+        spelling_cache=spelling_cache,
+        processes=processes,
+        output_path=output_path,
+        verbose=verbose,
     )
-    with Pool() as pool:
-        fixed_values = pool.map(fix_spelling_errors, values)
 
-    with open(f'../data/column_maps/{sheet}_{col}_map.json', 'w') as f:
-        json.dump({
-            x: y
-            for x, y in zip(values, fixed_values)
-        },
-            f,
-            indent=4,
-            sort_keys=True,
+
+def make_spelling_correction_maps(
+        dfs,
+        columns,
+        spelling_cache=None,
+        processes=None,
+        chunksize=64,
+        output_path='../data/column_maps',
+        verbose=False,
+):
+    """
+    Constructs the spelling correction maps of several text columns at once.
+
+    The unique values of every column are pooled so that a string shared by several
+    columns is corrected once, and corrections are looked up in the persistent
+    SpellingCache first. The remaining strings are spread over a single worker pool
+    in batches of chunksize, each worker holding its own spell checker.
+
+    Args:
+        dfs: Dictionary of sheets.
+        columns: List of (sheet, column) pairs to construct maps for.
+        spelling_cache: An open SpellingCache, one is opened (and closed) if None.
+        processes: Number of worker processes, defaults to the number of cores.
+        chunksize: Number of strings handed to a worker at a time.
+        output_path: Directory the {sheet}_{column}_map.json files are written to.
+        verbose: Report cache hits and progress.
+    """
+    column_values = {
+        (sheet, col): sorted(
+            dfs[sheet][col].str.lower().str.strip(' .,\"').str.replace('  ', ' ').dropna().unique()
         )
+        for sheet, col in columns
+    }
+    values = sorted(set(x for col_values in column_values.values() for x in col_values))
+
+    owns_cache = spelling_cache is None
+    if owns_cache:
+        spelling_cache = get_spelling_cache()
+
+    corrections = spelling_cache.get_many(values)
+    missing = [x for x in values if x not in corrections]
+    if verbose:
+        print(f'{len(values) - len(missing)}/{len(values)} unique strings cached, spell checking {len(missing)}')
+
+    if missing:
+        # With fork, loading the dictionaries in the parent lets the workers share them
+        # and the initializer is a no-op. Otherwise each worker loads its own copy once.
+        if get_start_method() == 'fork':
+            get_spell_checker()
+
+        start = time.perf_counter()
+        fixed = []
+        with Pool(processes=processes, initializer=get_spell_checker) as pool:
+            for x, y, t in pool.imap_unordered(timed_fix_spelling_errors, missing, chunksize):
+                corrections[x] = y
+                fixed.append((x, y, t))
+                # Flush regularly so that an interrupted run keeps its progress.
+                if len(fixed) >= 1000:
+                    spelling_cache.put_many(fixed)
+                    fixed = []
+            spelling_cache.put_many(fixed)
+
+        if verbose:
+            print(f'Spell checked {len(missing)} strings in {time.perf_counter() - start:.1f}s')
+
+    if owns_cache:
+        spelling_cache.close()
+
+    output_path = Path(output_path)
+    for (sheet, col), col_values in column_values.items():
+        with open(output_path / f'{sheet}_{col}_map.json', 'w') as f:
+            json.dump({
+                x: corrections[x]
+                for x in col_values
+            },
+                f,
+                indent=4,
+                sort_keys=True,
+            )
+
+
+def get_spelling_cache(path='../data/cache/spelling.sqlite', threshold=1):
+    return cache.SpellingCache(path, params=dict(SPELL_CHECKER_CONFIG, threshold=threshold, max_edit_distance=2))
 
 
 def make_column_correction_map(dfs, sheet, col):
@@ -251,8 +1227,36 @@ def make_column_correction_map(dfs, sheet, col):
         )
 
 
+@lru_cache(maxsize=None)
+def get_spell_checker():
+    """
+    Constructs the global spell checker on first use. Loading the unigram and bigram
+    dictionaries takes seconds and hundreds of MB, which is wasted whenever all of the
+    spelling correction maps already exist, so nothing is loaded at import time.
+    """
+    import pkg_resources
+    from symspellpy import SymSpell
+
+    sym_spell = SymSpell(
+        max_dictionary_edit_distance=SPELL_CHECKER_CONFIG['max_dictionary_edit_distance'],
+        prefix_length=SPELL_CHECKER_CONFIG['prefix_length'],
+    )
+    dictionary_path = pkg_resources.resource_filename(
+        "symspellpy",
+        SPELL_CHECKER_CONFIG['dictionary'],
+    )
+    bigram_path = pkg_resources.resource_filename(
+        "symspellpy",
+        SPELL_CHECKER_CONFIG['bigram_dictionary'],
+    )
+    # term_index is the column of the term and count_index is the column of the term frequency
+    sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
+    sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
+    return sym_spell
+
+
 def fix_spelling_errors(sample, threshold=1):
-    suggestions = sym_spell.lookup_compound(sample, max_edit_distance=2)
+    suggestions = get_spell_checker().lookup_compound(sample, max_edit_distance=2)
 
     # Suggestion object attributes:
     #  - term: the corrected string
@@ -265,41 +1269,97 @@ def fix_spelling_errors(sample, threshold=1):
         return sample
 
 
-def validate_sheet_locations(
+def timed_fix_spelling_errors(sample):
+    start = time.perf_counter()
+    return sample, fix_spelling_errors(sample), time.perf_counter() - start
+
+
+def validate_locations(
         dfs,
-        sheet_name,
         data_kind,
+        sheets=None,
         output_path='../data/column_discrepancies',
         verbose=False,
 ):
+    """
+    Checks the location columns of every sheet against the gazetteer in one pass and
+    writes a single report, {data_kind}_location_report.json, listing each issue with
+    the number of affected rows in total and per sheet:
+        - unknown_districts, unknown_chiefdoms, unknown_sections: names that are not
+          in the gazetteer at all.
+        - chiefdom_not_in_district: known chiefdoms paired with a known district they
+          do not belong to.
+        - section_not_in_chiefdom: known sections paired with a known chiefdom that
+          has no section with that name.
+
+    Args:
+        dfs: Dictionary of sheet name -> DataFrame.
+        data_kind: Either 'clean' or 'raw', prefixes the report name.
+        sheets: Sheets to validate, defaults to every sheet with location columns.
+        output_path: Directory the report is written to.
+        verbose: Print the number of distinct values and rows for every issue.
+
+    Returns:
+        The report as a dictionary.
+    """
     output_path = Path(output_path)
     output_path.mkdir(exist_ok=True, parents=True)
+    if sheets is None:
+        sheets = [sheet for sheet, df in dfs.items() if set(LOCATION_COLUMNS) <= set(df.columns)]
 
-    if verbose:
-        print(f'Validating {sheet_name} locations.')
+    locations = pd.concat(
+        [dfs[sheet][LOCATION_COLUMNS].astype(object).assign(Sheet=sheet) for sheet in sheets],
+        ignore_index=True,
+    )
+    for loc_col in LOCATION_COLUMNS:
+        # Strip every distinct value once rather than every row, missing values have code -1.
+        codes, uniques = pd.factorize(locations[loc_col])
+        locations[loc_col] = np.append(uniques.str.strip().to_numpy(dtype=object), np.nan)[codes]
 
-    districts = set(dfs[sheet_name].District.dropna().str.strip().unique())
-    district_issues = sorted(districts - set(sierra_leone.districts))
-    with open(output_path / f'{data_kind}_{sheet_name}_Districts.json', 'w') as f:
-        json.dump(district_issues, f, indent=4)
+    district_ids = GAZETTEER.encode('district', locations.District)
+    chiefdom_ids = GAZETTEER.encode('chiefdom', locations.Chiefdom)
+    section_ids = GAZETTEER.encode('section', locations.Section)
+    local_section_ids = GAZETTEER.encode('section', locations.Section, parent_ids=chiefdom_ids)
+    locations['Expected_District'] = GAZETTEER.decode('district', GAZETTEER.parent('chiefdom', chiefdom_ids))
 
-    chiefdoms = set(dfs[sheet_name].Chiefdom.dropna().str.strip().unique())
-    chiefdom_issues = sorted(chiefdoms - set(sierra_leone.chiefdoms))
-    with open(output_path / f'{data_kind}_{sheet_name}_Chiefdoms.json', 'w') as f:
-        json.dump(chiefdom_issues, f, indent=4)
+    issues = {
+        'unknown_districts': (locations.District.notna() & (district_ids == UNRESOLVED), ['District']),
+        'unknown_chiefdoms': (locations.Chiefdom.notna() & (chiefdom_ids == UNRESOLVED), ['Chiefdom']),
+        'unknown_sections': (locations.Section.notna() & (section_ids == UNRESOLVED), ['Section']),
+        'chiefdom_not_in_district': (
+            (district_ids != UNRESOLVED) & (chiefdom_ids != UNRESOLVED)
+            & ~GAZETTEER.is_within('chiefdom', chiefdom_ids, district_ids),
+            ['District', 'Chiefdom', 'Expected_District'],
+        ),
+        'section_not_in_chiefdom': (
+            (chiefdom_ids != UNRESOLVED) & (section_ids != UNRESOLVED) & (local_section_ids == UNRESOLVED),
+            ['District', 'Chiefdom', 'Section'],
+        ),
+    }
+
+    report = {
+        'data_kind': data_kind,
+        'rows': {sheet: len(dfs[sheet]) for sheet in sheets},
+        'summary': dict(),
+    }
+    for issue, (mask, columns) in issues.items():
+        entries = dict()
+        for (*key, sheet), n in locations[mask].groupby(columns + ['Sheet']).size().items():
+            entry = entries.setdefault(tuple(key), dict(zip((col.lower() for col in columns), key), rows=0, sheets=dict()))
+            entry['rows'] += int(n)
+            entry['sheets'][sheet] = int(n)
+        report[issue] = list(entries.values())
+        report['summary'][issue] = {'values': len(entries), 'rows': int(mask.sum())}
 
-    sections = set(dfs[sheet_name].Section.dropna().str.strip().unique())
-    section_issues = sorted(sections - set(sierra_leone.sections))
-    with open(output_path / f'{data_kind}_{sheet_name}_Sections.json', 'w') as f:
-        json.dump(section_issues, f, indent=4)
+    with open(output_path / f'{data_kind}_location_report.json', 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
 
     if verbose:
-        print(
-            f'{sheet_name} - {data_kind}:'
-            f'\n\tDistrict Issues: {len(district_issues)}'
-            f'\n\tChiefdom Issues: {len(chiefdom_issues)}'
-            f'\n\tSection Issues: {len(section_issues)}\n\n'
-        )
+        print(f'Location issues - {data_kind}:')
+        for issue, summary in report['summary'].items():
+            print(f'\t{issue}: {summary["values"]} values in {summary["rows"]} rows')
+
+    return report
 
 
 def check_location_maps(path='../data/column_maps'):
@@ -322,10 +1382,9 @@ def make_location_maps(dfs, sheets=None, output_path='../data/column_maps'):
     """
     output_path = Path(output_path)
     output_path.mkdir(exist_ok=True, parents=True)
-    sheets = sheets or ['Follow_Up', 'Trigger_NA', 'Trigger_Ave', 'Trigger_Other', 'Follow_Up_Other']
-    loc_cols = ['District', 'Chiefdom', 'Section']
+    sheets = sheets or CLEANED_SHEETS
 
-    for loc_col in loc_cols:
+    for loc_col in LOCATION_COLUMNS:
         mapping = dict()
         for sheet in sheets:
             sheet_map = {
@@ -334,7 +1393,7 @@ def make_location_maps(dfs, sheets=None, output_path='../data/column_maps'):
             }
             mapping.update(sheet_map)
 
-        with open(f'../data/column_maps/{loc_col.lower()}_map.json', 'w') as f:
+        with open(output_path / f'{loc_col.lower()}_map.json', 'w') as f:
             json.dump(
                 mapping,
                 f,
@@ -343,6 +1402,74 @@ def make_location_maps(dfs, sheets=None, output_path='../data/column_maps'):
             )
 
 
+class LazySheetDict(MutableMapping):
+    """
+    A dictionary of SMAC sheets that reads each sheet from disk the first time it is
+    accessed. Sheets can be replaced or removed like in a regular dictionary, and a
+    loaded sheet is kept so that in-place edits (e.g. by clean_smac_data) persist.
+    """
+    def __init__(
+            self,
+            data_kind='clean',
+            compact=True,
+            usecols=None,
+            use_cache=True,
+            cache_path='../data/cache',
+            data_path='../data',
+            verbose=False,
+    ):
+        self.data_kind = data_kind
+        self.compact = compact
+        self.usecols = usecols
+        self.use_cache = use_cache
+        self.cache_path = cache_path
+        self.verbose = verbose
+
+        self._paths = sheet_paths(data_kind, data_path=data_path)
+        self._sheets = dict()
+
+    def __getitem__(self, sheet):
+        if sheet not in self._sheets:
+            if sheet not in self._paths:
+                raise KeyError(sheet)
+
+            start = time.perf_counter()
+            self._sheets[sheet], hit = load_sheet(
+                self._paths[sheet],
+                compact=self.compact,
+                usecols=self.usecols,
+                use_cache=self.use_cache,
+                cache_path=self.cache_path,
+            )
+            if self.verbose:
+                source = 'cache' if hit else 'CSV'
+                print(f'Loaded {self.data_kind}/{sheet} from {source} in {time.perf_counter() - start:.3f}s')
+
+        return self._sheets[sheet]
+
+    def __setitem__(self, sheet, df):
+        self._sheets[sheet] = df
+
+    def __delitem__(self, sheet):
+        if sheet not in self._sheets and sheet not in self._paths:
+            raise KeyError(sheet)
+        self._sheets.pop(sheet, None)
+        self._paths.pop(sheet, None)
+
+    def __iter__(self):
+        return iter(sorted(set(self._paths) | set(self._sheets)))
+
+    def __len__(self):
+        return len(set(self._paths) | set(self._sheets))
+
+    def __repr__(self):
+        return f'{type(self).__name__}(data_kind={self.data_kind!r}, loaded={sorted(self._sheets)})'
+
+    @property
+    def loaded(self):
+        return sorted(self._sheets)
+
+
 class IDDict(dict):
     """
     pandas.Series.map takes a dictionary and uses it to modify values in the series.
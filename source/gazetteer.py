@@ -0,0 +1,217 @@
+"""
+Integer coded view of the sierra_leone gazetteer.
+
+Every province, district, chiefdom and section gets an integer ID, the hierarchy
+is stored as arrays of parent IDs and names are looked up through dictionaries,
+so validating or joining location columns works on small integer codes instead
+of strings.
+
+IDs follow the sorted names for provinces, districts and chiefdoms (the same
+order as the sierra_leone lists, so the codes of a location category built from
+those lists are the IDs). Section names are not unique across chiefdoms, hence a
+section ID identifies a (chiefdom, section) pair and the sections of a chiefdom
+have contiguous IDs, ordered by chiefdom ID then name.
+
+The compiled gazetteer is pickled under data/cache and keyed on the digest of
+sierra_leone.py, the dict literals are only evaluated again when that file
+changes.
+"""
+
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cache import file_digest
+
+# Bump this whenever the layout of the Gazetteer changes.
+GAZETTEER_VERSION = 1
+
+SOURCE_PATH = Path(__file__).resolve().parent / 'sierra_leone.py'
+CACHE_PATH = Path(__file__).resolve().parent.parent / 'data' / 'cache' / 'gazetteer.pkl'
+
+LEVELS = ('province', 'district', 'chiefdom', 'section')
+PARENT_LEVEL = {'district': 'province', 'chiefdom': 'district', 'section': 'chiefdom'}
+
+# Code used for names that are missing or not in the gazetteer.
+UNRESOLVED = -1
+
+
+class Gazetteer:
+    """
+    Args:
+        province2districts: Dictionary of province -> list of districts.
+        district2chiefdoms: Dictionary of district -> list of chiefdoms.
+        chiefdom2sections: Dictionary of chiefdom -> list of sections.
+
+    Attributes:
+        names: Dictionary of level -> tuple of names indexed by ID.
+        unique_names: Dictionary of level -> sorted tuple of distinct names, only
+            differs from names for sections.
+        name_sets: Dictionary of level -> frozenset of the names.
+        parents: Dictionary of level -> array of the parent ID of every ID.
+        ids: Dictionary of level -> dictionary of name -> ID. For sections the ID is
+            the one in the first chiefdom (by ID) that has a section with that name.
+    """
+    def __init__(self, province2districts, district2chiefdoms, chiefdom2sections):
+        provinces = sorted(province2districts)
+        districts = sorted(d for ds in province2districts.values() for d in ds)
+        chiefdoms = sorted(c for cs in district2chiefdoms.values() for c in cs)
+        sections = [
+            (chiefdom_id, section)
+            for chiefdom_id, chiefdom in enumerate(chiefdoms)
+            for section in sorted(set(chiefdom2sections[chiefdom]))
+        ]
+
+        self.names = {
+            'province': tuple(provinces),
+            'district': tuple(districts),
+            'chiefdom': tuple(chiefdoms),
+            'section': tuple(section for _, section in sections),
+        }
+        self.unique_names = {level: tuple(sorted(set(names))) for level, names in self.names.items()}
+        self.name_sets = {level: frozenset(names) for level, names in self.names.items()}
+
+        self.ids = {level: dict() for level in LEVELS}
+        for level, names in self.names.items():
+            for i, name in enumerate(names):
+                self.ids[level].setdefault(name, i)
+
+        district2province = {d: p for p, ds in province2districts.items() for d in ds}
+        chiefdom2district = {c: d for d, cs in district2chiefdoms.items() for c in cs}
+        self.parents = {
+            'district': self._codes('province', [district2province[x] for x in districts]),
+            'chiefdom': self._codes('district', [chiefdom2district[x] for x in chiefdoms]),
+            'section': np.array([chiefdom_id for chiefdom_id, _ in sections], dtype=np.int32),
+        }
+
+        # Sections are encoded through the code of their name within unique_names,
+        # combined with the chiefdom ID into a single sortable key.
+        section_name_codes = self._codes('section', self.names['section'], unique=True)
+        self._section_first_ids = np.full(len(self.unique_names['section']), UNRESOLVED, dtype=np.int32)
+        for i, code in reversed(list(enumerate(section_name_codes))):
+            self._section_first_ids[code] = i
+        self._section_keys = self._section_key(self.parents['section'], section_name_codes)
+
+    def __len__(self):
+        return sum(len(names) for names in self.names.values())
+
+    def __repr__(self):
+        counts = ', '.join(f'{level}s={len(self.names[level])}' for level in LEVELS)
+        return f'{type(self).__name__}({counts})'
+
+    def _codes(self, level, values, unique=False):
+        categories = self.unique_names[level] if unique or level == 'section' else self.names[level]
+        return pd.Categorical(values, categories=categories).codes.astype(np.int32)
+
+    def _section_key(self, chiefdom_ids, name_codes):
+        return chiefdom_ids.astype(np.int64) * len(self.unique_names['section']) + name_codes
+
+    def encode(self, level, values, parent_ids=None):
+        """
+        Converts names to IDs.
+
+        Args:
+            level: One of LEVELS.
+            values: Sequence of names, typically a column of a sheet.
+            parent_ids: Only used for sections, the chiefdom ID of every value. When
+                given, a section is only resolved within its chiefdom, otherwise the
+                first chiefdom with a section of that name is used.
+
+        Returns:
+            An int32 array with the ID of every value or UNRESOLVED.
+        """
+        if level != 'section':
+            return self._codes(level, values)
+
+        name_codes = self._codes('section', values)
+        if parent_ids is None:
+            ids = self._section_first_ids[name_codes]
+            ids[name_codes == UNRESOLVED] = UNRESOLVED
+            return ids
+
+        parent_ids = np.asarray(parent_ids, dtype=np.int32)
+        keys = self._section_key(parent_ids, name_codes)
+        positions = np.searchsorted(self._section_keys, keys).clip(max=len(self._section_keys) - 1)
+        found = (self._section_keys[positions] == keys) & (name_codes != UNRESOLVED) & (parent_ids != UNRESOLVED)
+        return np.where(found, positions, UNRESOLVED).astype(np.int32)
+
+    def decode(self, level, ids):
+        """
+        Converts IDs back to names, UNRESOLVED becomes None.
+        """
+        names = np.array(self.names[level] + (None, ), dtype=object)
+        return names[np.asarray(ids)]
+
+    def parent(self, level, ids):
+        """
+        Returns the parent ID of every ID, UNRESOLVED stays UNRESOLVED.
+        """
+        parents = np.append(self.parents[level], UNRESOLVED)
+        return parents[np.asarray(ids)]
+
+    def ancestor(self, level, ids, to_level):
+        """
+        Walks the parent arrays up from level to to_level, e.g. section -> district.
+        """
+        while level != to_level:
+            ids, level = self.parent(level, ids), PARENT_LEVEL[level]
+        return ids
+
+    def children(self, level, parent_id):
+        """
+        Returns the IDs at level whose parent is parent_id.
+        """
+        return np.flatnonzero(self.parents[level] == parent_id)
+
+    def is_within(self, level, ids, parent_ids):
+        """
+        Checks that every ID belongs to the given parent ID. Rows where either ID is
+        UNRESOLVED are reported as False.
+        """
+        ids, parent_ids = np.asarray(ids), np.asarray(parent_ids)
+        return (ids != UNRESOLVED) & (parent_ids != UNRESOLVED) & (self.parent(level, ids) == parent_ids)
+
+
+def build_gazetteer():
+    import sierra_leone
+
+    return Gazetteer(
+        sierra_leone.province2districts,
+        sierra_leone.district2chiefdoms,
+        sierra_leone.chiefdom2sections,
+    )
+
+
+def load_gazetteer(path=CACHE_PATH, source_path=SOURCE_PATH):
+    """
+    Loads the compiled gazetteer, rebuilding it from sierra_leone.py when the cached
+    copy is missing, was built by another GAZETTEER_VERSION or from a different file.
+    """
+    path = Path(path)
+    digest = file_digest(source_path)
+    if path.is_file():
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') == GAZETTEER_VERSION and cached.get('sha1') == digest:
+            return cached['gazetteer']
+
+    gazetteer = build_gazetteer()
+    try:
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(
+                {'version': GAZETTEER_VERSION, 'sha1': digest, 'gazetteer': gazetteer},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        tmp_path.replace(path)
+    except OSError:
+        # A read-only checkout still works, it just rebuilds on every import.
+        pass
+    return gazetteer
+
+
+GAZETTEER = load_gazetteer()
@@ -0,0 +1,358 @@
+"""
+Fuzzy resolution of raw (District, Chiefdom, Section) triples against the sierra_leone
+gazetteer.
+
+Names are matched with a SymSpell style deletes index: every gazetteer name is
+indexed under all of the strings obtained by deleting up to max_distance characters,
+so the candidates for a query are found by generating the deletes of the query
+instead of comparing against every name. Candidates are then verified with the
+optimal string alignment distance.
+
+The hierarchy constrains the search. Chiefdoms are first looked up among the
+chiefdoms of the resolved district and sections among the sections of the resolved
+chiefdom, only falling back to the whole gazetteer (with a lower confidence) when
+that fails. Hand-curated spellings from data/column_maps can be supplied as aliases,
+which are trusted as long as they point to a gazetteer name.
+"""
+
+import argparse
+import json
+import re
+import time
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+import sierra_leone
+
+Resolution = namedtuple(
+    'Resolution',
+    ['district', 'chiefdom', 'section', 'district_score', 'chiefdom_score', 'section_score'],
+)
+
+# Confidence multiplier for matches that ignore the hierarchy (e.g. a chiefdom that is
+# not in the stated district).
+HIERARCHY_PENALTY = 0.75
+
+ROMAN_NUMERALS = {'i': '1', 'ii': '2', 'iii': '3', 'iv': '4', 'v': '5'}
+
+# Every chiefdom that has a section of a given name.
+SECTION2CHIEFDOMS = {
+    section: [chiefdom for chiefdom, sections in sierra_leone.chiefdom2sections.items() if section in sections]
+    for section in set(sierra_leone.sections)
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Resolves the location columns of the SMAC sheets against the sierra_leone gazetteer.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        '--data_kind',
+        type=lambda x: x.lower(),
+        default='raw',
+        choices=['clean', 'raw'],
+        help='Determines the data flavor that is resolved.',
+    )
+    parser.add_argument(
+        '--output_path',
+        type=str,
+        default='../data/column_discrepancies',
+        help='Directory the resolved triples are written to.',
+    )
+    parser.add_argument(
+        '--use_aliases',
+        type=lambda x: x.lower() in {'true', 't', '1'},
+        default=True,
+        help='Trusts the hand-curated location maps in data/column_maps.',
+    )
+    return parser
+
+
+def main(data_kind='raw', output_path='../data/column_discrepancies', use_aliases=True):
+    from etl import load_smac_data, CLEANED_SHEETS, LOCATION_COLUMNS
+
+    dfs = load_smac_data(data_kind, compact=False, usecols=LOCATION_COLUMNS)
+    triples = pd.concat([dfs[sheet] for sheet in CLEANED_SHEETS]).drop_duplicates()
+
+    start = time.perf_counter()
+    resolver = LocationResolver.from_column_maps() if use_aliases else LocationResolver()
+    resolved = resolve_triples(triples, resolver)
+    print(f'Resolved {len(resolved)} unique triples in {time.perf_counter() - start:.3f}s')
+
+    for level in ['district', 'chiefdom', 'section']:
+        scores = resolved[f'{level}_score']
+        print(f'\t{level.capitalize()}: {(scores > 0).mean():.1%} resolved, mean confidence {scores.mean():.2f}')
+
+    output_path = Path(output_path)
+    output_path.mkdir(exist_ok=True, parents=True)
+    resolved.to_csv(output_path / f'{data_kind}_location_resolutions.csv', index=False)
+
+
+@lru_cache(maxsize=None)
+def normalize_name(name):
+    """
+    Reduces a location name to lower case alphanumeric words, dropping bracketed
+    annotations and turning trailing roman numerals into digits, e.g.
+    'Zombo [1]' -> 'zombo 1', 'Saba I' -> 'saba 1', 'Bendu-Cha' -> 'bendu cha'.
+    """
+    name = re.sub(r'[\[\]()]', ' ', str(name).lower())
+    words = re.sub(r'[^a-z0-9]+', ' ', name).split()
+    if len(words) > 1 and words[-1] in ROMAN_NUMERALS:
+        words[-1] = ROMAN_NUMERALS[words[-1]]
+    return ' '.join(words)
+
+
+def max_distance_for(key):
+    if len(key) <= 3:
+        return 0
+    if len(key) <= 6:
+        return 1
+    return 2
+
+
+@lru_cache(maxsize=None)
+def deletes(word, max_distance):
+    """
+    Returns every string obtained by deleting up to max_distance characters from word.
+    Cached since the per district and chiefdom indices re-index the same names.
+    """
+    variants = frontier = {word}
+    for _ in range(max_distance):
+        frontier = {x[:i] + x[i + 1:] for x in frontier for i in range(len(x))}
+        variants = variants | frontier
+    return frozenset(variants)
+
+
+def osa_distance(a, b, max_distance):
+    """
+    Optimal string alignment distance (Levenshtein plus adjacent transpositions),
+    returning max_distance + 1 as soon as the distance is known to exceed max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class DeletesIndex:
+    """
+    Edit distance index over a set of names, see the module docstring.
+    """
+    def __init__(self, names, max_distance=2):
+        self.max_distance = max_distance
+        self._key2names = defaultdict(list)
+        self._index = defaultdict(set)
+
+        for name in dict.fromkeys(names):
+            key = normalize_name(name)
+            self._key2names[key].append(name)
+            for variant in deletes(key, max_distance):
+                self._index[variant].add(key)
+
+    def __len__(self):
+        return len(self._key2names)
+
+    def __contains__(self, name):
+        return normalize_name(name) in self._key2names
+
+    def lookup(self, query):
+        """
+        Returns:
+            A tuple (name, score) for the best match, or (None, 0.) when nothing is
+            within the allowed distance. The score is 1 for an exact (normalized) match
+            and decreases with the edit distance relative to the name length. Ties
+            between different names divide the score.
+        """
+        key = normalize_name(query)
+        if not key:
+            return None, 0.
+        if key in self._key2names:
+            names = self._key2names[key]
+            return names[0], 1. / len(names)
+
+        max_distance = min(max_distance_for(key), self.max_distance)
+        if max_distance == 0:
+            return None, 0.
+
+        candidates = set()
+        for variant in deletes(key, max_distance):
+            candidates.update(self._index.get(variant, ()))
+
+        best_distance, best = max_distance + 1, []
+        for candidate in sorted(candidates):
+            distance = osa_distance(key, candidate, max_distance)
+            if distance < best_distance:
+                best_distance, best = distance, [candidate]
+            elif distance == best_distance:
+                best.append(candidate)
+
+        if not best or best_distance > max_distance:
+            return None, 0.
+
+        names = [name for candidate in best for name in self._key2names[candidate]]
+        score = 1. - best_distance / max(len(key), len(best[0]))
+        return names[0], score / len(names)
+
+
+class LocationResolver:
+    """
+    Resolves (District, Chiefdom, Section) triples, see the module docstring.
+
+    Args:
+        aliases: Optional dictionary of level ('district', 'chiefdom', 'section') to a
+            dictionary of raw spelling -> gazetteer name. Only aliases that point to a
+            name in the gazetteer are used.
+    """
+    def __init__(self, aliases=None):
+        self.aliases = dict()
+        for level, names in [
+            ('district', sierra_leone.districts),
+            ('chiefdom', sierra_leone.chiefdoms),
+            ('section', sierra_leone.sections),
+        ]:
+            names = set(names)
+            self.aliases[level] = {
+                normalize_name(raw): name
+                for raw, name in (aliases or dict()).get(level, dict()).items()
+                if name in names
+            }
+
+        self.district_index = DeletesIndex(sierra_leone.districts)
+        self.chiefdom_index = DeletesIndex(sierra_leone.chiefdoms)
+        self.section_index = DeletesIndex(sierra_leone.sections)
+        # Per district/chiefdom indices are only built once a triple needs them.
+        self._child_indices = dict()
+        self._memo = dict()
+
+    def child_index(self, level, parent):
+        """
+        Returns the DeletesIndex over the chiefdoms of a district (level='chiefdom')
+        or the sections of a district or chiefdom (level='section').
+        """
+        key = (level, parent)
+        if key not in self._child_indices:
+            if level == 'chiefdom':
+                names = sierra_leone.district2chiefdoms[parent]
+            elif parent in sierra_leone.chiefdom2sections:
+                names = sierra_leone.chiefdom2sections[parent]
+            else:
+                names = [
+                    section
+                    for chiefdom in sierra_leone.district2chiefdoms[parent]
+                    for section in sierra_leone.chiefdom2sections[chiefdom]
+                ]
+            self._child_indices[key] = DeletesIndex(names)
+        return self._child_indices[key]
+
+    @classmethod
+    def from_column_maps(cls, path='../data/column_maps'):
+        aliases = dict()
+        for level in ['district', 'chiefdom', 'section']:
+            map_file = Path(path) / f'{level}_map.json'
+            if map_file.is_file():
+                with open(map_file) as f:
+                    aliases[level] = json.load(f)
+        return cls(aliases=aliases)
+
+    def resolve(self, district, chiefdom, section):
+        """
+        Returns:
+            A Resolution with the gazetteer names (None when unresolved) and a
+            confidence score in [0, 1] for each level.
+        """
+        district, district_score = self._lookup('district', district, [(self.district_index, 1.)])
+
+        if district is not None:
+            chain = [(self.child_index('chiefdom', district), 1.), (self.chiefdom_index, HIERARCHY_PENALTY)]
+        else:
+            chain = [(self.chiefdom_index, 1.)]
+        chiefdom, chiefdom_score = self._lookup('chiefdom', chiefdom, chain)
+        if district is None and chiefdom is not None:
+            # The chiefdom pins down the district when the district itself is unusable.
+            district, district_score = sierra_leone.chiefdom2district[chiefdom], chiefdom_score * HIERARCHY_PENALTY
+
+        chain = []
+        if chiefdom is not None:
+            chain.append((self.child_index('section', chiefdom), 1.))
+        if district is not None:
+            chain.append((self.child_index('section', district), HIERARCHY_PENALTY ** len(chain)))
+        chain.append((self.section_index, HIERARCHY_PENALTY ** len(chain)))
+        section, section_score = self._lookup('section', section, chain)
+
+        if chiefdom is None and section is not None:
+            # Section names are not unique, so the chiefdom is only inferred when a
+            # single chiefdom has a section of that name, within the resolved district
+            # if there is one and across the whole gazetteer otherwise.
+            candidates = [
+                x for x in SECTION2CHIEFDOMS[section]
+                if district is None or sierra_leone.chiefdom2district[x] == district
+            ]
+            if len(candidates) == 1:
+                chiefdom = candidates[0]
+                chiefdom_score = section_score * HIERARCHY_PENALTY
+                if district is None:
+                    district = sierra_leone.chiefdom2district[chiefdom]
+                    district_score = section_score * HIERARCHY_PENALTY ** 2
+
+        return Resolution(district, chiefdom, section, district_score, chiefdom_score, section_score)
+
+    def _lookup(self, level, raw, chain):
+        """
+        Looks raw up in each index of chain in turn, a list of (DeletesIndex, weight)
+        pairs going from the most to the least constrained, and weights the score by
+        the index that matched.
+        """
+        if raw is None or (isinstance(raw, float) and raw != raw):
+            return None, 0.
+
+        memo_key = (level, raw, tuple(id(index) for index, _ in chain))
+        if memo_key in self._memo:
+            return self._memo[memo_key]
+
+        name, score = None, 0.
+        alias = self.aliases[level].get(normalize_name(raw))
+        if alias is not None:
+            weights = [weight for index, weight in chain if alias in index]
+            name, score = alias, weights[0] if weights else HIERARCHY_PENALTY ** len(chain)
+        else:
+            for index, weight in chain:
+                name, score = index.lookup(raw)
+                if name is not None:
+                    score *= weight
+                    break
+
+        self._memo[memo_key] = name, score
+        return name, score
+
+
+def resolve_triples(triples, resolver=None):
+    """
+    Resolves every row of a DataFrame with District, Chiefdom and Section columns.
+
+    Returns:
+        A DataFrame with the raw columns followed by the resolved names and scores.
+    """
+    resolver = resolver or LocationResolver()
+    triples = triples[['District', 'Chiefdom', 'Section']].drop_duplicates().reset_index(drop=True)
+    resolutions = [resolver.resolve(*triple) for triple in triples.itertuples(index=False)]
+    return pd.concat([triples, pd.DataFrame(resolutions, columns=Resolution._fields)], axis=1)
+
+
+if __name__ == '__main__':
+    main(**vars(get_parser().parse_args()))
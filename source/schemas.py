@@ -0,0 +1,297 @@
+"""
+Explicit column schemas for the SMAC sheets.
+
+pandas infers every column when reading the CSVs, which turns count columns into
+float64 (any missing value forces it) and location columns into object strings.
+The registry below assigns each column a kind using the Codebook plus the columns
+that clean_smac_data is known to handle, and apply_schema converts a sheet to the
+matching compact dtypes:
+    - count: # of people, sick, referred, deaths, burials -> Int16
+    - total: totals that can exceed a few hundred -> Int32
+    - flag: yes/no questions -> Int8
+    - date: visit/trigger dates -> datetime64
+    - location: District, Chiefdom, Section -> category backed by the gazetteer
+
+Conversions are only applied when they are lossless. A raw column that contains a
+typo such as 'o' instead of '0', or a date that will not parse, is left with the
+dtype pandas inferred so that nothing in the raw data is silently discarded.
+"""
+
+import hashlib
+import re
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cache
+from gazetteer import GAZETTEER
+
+# Bump this whenever the kinds or the conversion rules change, it keys the sheet cache.
+SCHEMA_VERSION = 1
+
+CODEBOOK_PATH = '../data/clean/all_paper_data_Codebook.csv'
+
+COUNT_PREFIXES = ('ss_', 'r_', 'd_', 'b_', 'cb_')
+TOTAL_COLUMNS = {'total_male', 'total_female', 'grand_total'}
+DATE_COLUMNS = {'trig_date', 'date_of_visit', 'date_of_dep'}
+LOCATION_COLUMNS = {
+    'district': GAZETTEER.unique_names['district'],
+    'chiefdom': GAZETTEER.unique_names['chiefdom'],
+    'section': GAZETTEER.unique_names['section'],
+}
+
+KIND2DTYPE = {
+    'count': 'Int16',
+    'total': 'Int32',
+    'flag': 'Int8',
+}
+WIDER_INTS = ['Int8', 'Int16', 'Int32', 'Int64']
+
+# Counts typed with the letter o in place of zeros, e.g. 'o' or '1O'.
+ZERO_TYPOS = re.compile(r'[0-9oO]+')
+LETTER_O_ZEROS = re.compile(r'[oO]')
+
+
+@lru_cache(maxsize=None)
+def schema_digest(codebook_path=CODEBOOK_PATH):
+    """
+    Returns a digest of what the compact dtypes are derived from besides the sheet:
+    the Codebook (column kinds), the gazetteer sources (location categories) and the
+    conversion code. It is stored with the cached sheets, which are rebuilt when it
+    changes.
+    """
+    source_path = Path(__file__).resolve().parent
+    paths = [Path(codebook_path)] + [source_path / name for name in ['schemas.py', 'gazetteer.py', 'sierra_leone.py']]
+    digest = hashlib.sha1(str(SCHEMA_VERSION).encode())
+    for path in paths:
+        digest.update(cache.file_digest(path).encode())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def load_codebook_kinds(path=CODEBOOK_PATH):
+    """
+    Derives column kinds from the Codebook interpretations.
+
+    Returns:
+        A dictionary mapping lower-cased column codes to a kind.
+    """
+    codebook = pd.read_csv(path).dropna()
+
+    kinds = dict()
+    for code, interpretation in zip(codebook.Code, codebook.Interpretation):
+        code = code.strip().lower()
+        interpretation = interpretation.strip().lower()
+        if code in TOTAL_COLUMNS:
+            kinds[code] = 'total'
+        elif interpretation.startswith('#') or code.startswith(COUNT_PREFIXES):
+            kinds[code] = 'count'
+        elif re.search(r'\byes\b', interpretation) and re.search(r'\bno\b', interpretation):
+            kinds[code] = 'flag'
+        elif code in DATE_COLUMNS:
+            kinds[code] = 'date'
+        elif code in LOCATION_COLUMNS:
+            kinds[code] = 'location'
+    return kinds
+
+
+def column_kind(col):
+    """
+    Returns the kind of a column, or None if it should keep the dtype pandas infers.
+    Column names are matched case-insensitively since the sheets disagree on case
+    (e.g. Male_child vs Male_Child, Date_of_visit vs Date_of_Visit).
+    """
+    key = col.strip().lower()
+    kind = load_codebook_kinds().get(key)
+    if kind is not None:
+        return kind
+
+    if key in TOTAL_COLUMNS:
+        return 'total'
+    if key in DATE_COLUMNS:
+        return 'date'
+    if key in LOCATION_COLUMNS:
+        return 'location'
+    if key.startswith(COUNT_PREFIXES):
+        return 'count'
+    return None
+
+
+def get_schema(columns):
+    return {
+        col: kind
+        for col, kind in ((col, column_kind(col)) for col in columns)
+        if kind is not None
+    }
+
+
+def apply_schema(df, sheet_name=None, plan=None):
+    """
+    Converts the columns of a sheet to the compact dtypes given by the registry.
+
+    Args:
+        df: The sheet as read by pandas.
+        sheet_name: Name of the sheet, the Codebook itself is returned unchanged.
+        plan: Optional result of plan_schema. By default the plan is derived from df,
+            passing one in forces the same conversions on every chunk of a sheet.
+
+    Returns:
+        A new DataFrame, columns that cannot be converted losslessly are unchanged.
+    """
+    if sheet_name == 'Codebook':
+        return df
+    if plan is None:
+        plan = plan_schema(df, sheet_name=sheet_name)
+
+    df = df.copy()
+    for col, dtype in plan.items():
+        if col not in df.columns:
+            continue
+        if dtype == 'category':
+            df[col] = to_location(df[col], LOCATION_COLUMNS[col.strip().lower()])
+        elif dtype == 'datetime64[ns]':
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def plan_schema(df, sheet_name=None):
+    """
+    Determines which columns of a sheet can be converted losslessly and to what.
+
+    Returns:
+        A dictionary mapping column names to the target dtype name.
+    """
+    if sheet_name == 'Codebook':
+        return dict()
+
+    plan = dict()
+    for col, kind in get_schema(df.columns).items():
+        series = df[col]
+        if kind == 'location':
+            converted = to_location(series, LOCATION_COLUMNS[col.strip().lower()])
+        elif kind == 'date':
+            converted = to_date(series)
+        else:
+            converted = to_int(series, KIND2DTYPE[kind])
+
+        if converted is not series:
+            plan[col] = str(converted.dtype) if kind != 'location' else 'category'
+    return plan
+
+
+def merge_plans(plan_a, plan_b):
+    """
+    Combines the plans of two chunks of the same sheet. A column is only converted
+    when every chunk allows it, integer columns take the wider of the two dtypes.
+    """
+    if plan_a is None:
+        return dict(plan_b)
+
+    merged = dict()
+    for col in plan_a.keys() & plan_b.keys():
+        dtype_a, dtype_b = plan_a[col], plan_b[col]
+        if dtype_a == dtype_b:
+            merged[col] = dtype_a
+        elif dtype_a in WIDER_INTS and dtype_b in WIDER_INTS:
+            merged[col] = max(dtype_a, dtype_b, key=WIDER_INTS.index)
+    return merged
+
+
+def to_int(series, dtype):
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        return series
+
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    present = values[~np.isnan(values)]
+    if not np.array_equal(present, np.round(present)):
+        return series
+
+    int_dtype = fitting_int_dtype(present, dtype)
+    return series if int_dtype is None else series.astype(int_dtype)
+
+
+def fitting_int_dtype(values, dtype):
+    """
+    Returns the first of WIDER_INTS, starting at dtype, that holds every value, or None.
+    Widening the requested dtype when the data does not fit avoids overflows.
+    """
+    for candidate in WIDER_INTS[WIDER_INTS.index(dtype):]:
+        info = np.iinfo(candidate.lower())
+        if values.size == 0 or (info.min <= values.min() and values.max() <= info.max):
+            return candidate
+    return None
+
+
+def to_count(series, dtype='Int16'):
+    """
+    Coerces a count column that may hold typed text to a nullable integer dtype.
+
+    Text is parsed once per distinct value: whitespace is stripped, a letter o typed
+    instead of a zero is replaced when the value is otherwise all digits (e.g. 'o',
+    '1O'), 'nan' and empty strings count as missing and the rest goes through
+    pd.to_numeric. Columns with fractional values (e.g. averages) are returned as
+    float64.
+
+    Returns:
+        A tuple of the converted series and a boolean array marking the values that
+        were present but could not be parsed, these are NA in the converted series.
+    """
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        numbers = series.to_numpy(dtype='float64', na_value=np.nan)
+        failed = np.zeros(len(series), dtype=bool)
+    else:
+        codes, uniques = pd.factorize(series)
+        text = [str(x).strip() for x in uniques]
+        text = [
+            np.nan if x.lower() in {'', 'nan'} else LETTER_O_ZEROS.sub('0', x) if ZERO_TYPOS.fullmatch(x) else x
+            for x in text
+        ]
+        parsed = pd.to_numeric(np.array(text, dtype=object), errors='coerce').astype('float64')
+        numbers = np.append(parsed, np.nan)[codes]
+        failed = np.append(np.isnan(parsed) & pd.notna(text), False)[codes]
+
+    missing = np.isnan(numbers)
+    present = numbers[~missing]
+    int_dtype = fitting_int_dtype(present, dtype) if np.array_equal(present, np.round(present)) else None
+    if int_dtype is None:
+        return pd.Series(numbers, index=series.index, name=series.name), failed
+
+    values = pd.arrays.IntegerArray(np.where(missing, 0, numbers).astype(int_dtype.lower()), missing)
+    return pd.Series(values, index=series.index, name=series.name), failed
+
+
+def to_date(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+
+    dates = pd.to_datetime(series, errors='coerce')
+    if (dates.isna() != series.isna()).any():
+        return series
+    return dates
+
+
+def to_location(series, gazetteer_names):
+    if not (pd.api.types.is_object_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype)):
+        return series
+
+    # Gazetteer names come first so that codes for valid names are identical across
+    # sheets, any unrecognized spellings in the data are appended after them.
+    # Section names are not unique across chiefdoms, hence the dict.fromkeys.
+    known = list(dict.fromkeys(gazetteer_names))
+    extra = sorted(set(series.dropna().unique()) - set(known))
+    categories = pd.CategoricalDtype(known + extra)
+    return series.astype(categories)
+
+
+def memory_usage(dfs):
+    """
+    Returns the deep memory usage of each sheet in megabytes.
+    """
+    return {
+        sheet: df.memory_usage(deep=True).sum() / 1e6
+        for sheet, df in dfs.items()
+    }